@@ -0,0 +1,386 @@
+#!/usr/bin/env python2
+
+"""
+Benchmarks the stages of package_dependencies.py on synthetic data.
+
+Fixtures (a Debian Packages.gz, an RPM repository, a global requirements
+file and a pip resolver log) are generated offline and served by a local
+HTTP server, so runs are repeatable and need no network access. Timings
+are written as JSON, to compare them between versions.
+"""
+
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import hashlib
+import platform
+import threading
+import time
+import argparse
+import SocketServer
+import SimpleHTTPServer
+from email.utils import parsedate_tz, mktime_tz
+from tempfile import mkdtemp
+
+import package_dependencies as pd
+
+
+WORDS = [
+    'alpha', 'babel', 'cinder', 'client', 'config', 'crypto', 'daemon', 'eventlet',
+    'glance', 'heat', 'httplib', 'i18n', 'jinja', 'json', 'keystone', 'kombu',
+    'lxml', 'messaging', 'mock', 'murano', 'netaddr', 'neutron', 'nova', 'oslo',
+    'paste', 'pbr', 'psutil', 'pycrypto', 'pyyaml', 'requests', 'routes', 'six',
+    'sqlalchemy', 'stevedore', 'swift', 'tempest', 'utils', 'webob', 'yaql', 'zope'
+]
+
+
+def python_names(count, seed=0):
+    """
+    Returns 'count' distinct Python project names, the same on every run.
+    """
+    rnd = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = '-'.join(rnd.sample(WORDS, rnd.randint(1, 3)))
+        if name in seen:
+            name = "{0}{1}".format(name, len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def distro_names(count, python_projects, seed=0):
+    """
+    Returns 'count' package names, a distribution-like mix of 'python-*'
+    packages built from 'python_projects' and unrelated libraries and tools.
+    """
+    rnd = random.Random(seed)
+    names = ['python-{0}'.format(n) for n in python_projects]
+    while len(names) < count:
+        names.append("{0}{1}-{2}".format(
+            rnd.choice(['lib', 'gir1.2-', 'fonts-', '']),
+            rnd.choice(WORDS), len(names)))
+    return names[:count]
+
+
+def generate_packages_gz(path, names, seed=0):
+    """
+    Writes a Debian 'Packages.gz' with one stanza per name, every tenth
+    package having two versions.
+    """
+    rnd = random.Random(seed)
+    with gzip.open(path, 'wb') as index_file:
+        for i, name in enumerate(names):
+            for version_count in range(2 if i % 10 == 0 else 1):
+                version = "{0}{1}.{2}.{3}-{4}ubuntu{5}".format(
+                    '1:' if i % 7 == 0 else '', rnd.randint(0, 5), rnd.randint(0, 20),
+                    rnd.randint(0, 9), rnd.randint(1, 3), version_count + 1)
+                index_file.write(
+                    "Package: {0}\n"
+                    "Source: {1}\n"
+                    "Version: {2}\n"
+                    "Architecture: all\n"
+                    "Depends: python (>= 2.7), {3}\n"
+                    "Provides: {0}-api\n"
+                    "Filename: pool/main/{4}/{1}/{0}_{2}_all.deb\n"
+                    "Size: {5}\n"
+                    "SHA256: {6}\n"
+                    "Description: synthetic package {0}\n"
+                    " Long description line.\n"
+                    "\n".format(
+                        name, name.split('-')[0], version, rnd.choice(names),
+                        name[0], rnd.randint(1000, 100000),
+                        hashlib.sha256(name + version).hexdigest()))
+
+
+def generate_rpm_repository(repo_path, names, seed=0):
+    """
+    Writes repodata/repomd.xml and a checksum-named primary.xml.gz.
+    """
+    rnd = random.Random(seed)
+    repodata_path = os.path.join(repo_path, 'repodata')
+    os.makedirs(repodata_path)
+    primary_path = os.path.join(repodata_path, 'primary.xml.gz')
+    with gzip.open(primary_path, 'wb') as primary_file:
+        primary_file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="{0}" xmlns:rpm="http://linux.duke.edu/metadata/rpm"'
+            ' packages="{1}">\n'.format(pd.RPM_COMMON_NS, len(names)))
+        for name in names:
+            version = "{0}.{1}.{2}".format(
+                rnd.randint(0, 5), rnd.randint(0, 20), rnd.randint(0, 9))
+            release = "{0}.el6".format(rnd.randint(1, 3))
+            primary_file.write(
+                '<package type="rpm"><name>{0}</name><arch>noarch</arch>'
+                '<version epoch="0" ver="{1}" rel="{2}"/>'
+                '<checksum type="sha256" pkgid="YES">{3}</checksum>'
+                '<summary>synthetic package {0}</summary>'
+                '<location href="Packages/{0}-{1}-{2}.noarch.rpm"/>'
+                '<format><rpm:provides><rpm:entry name="{0}"/></rpm:provides>'
+                '<rpm:requires><rpm:entry name="{4}"/></rpm:requires></format>'
+                '</package>\n'.format(
+                    name, version, release,
+                    hashlib.sha256(name + version).hexdigest(), rnd.choice(names)))
+        primary_file.write('</metadata>\n')
+
+    with open(primary_path, 'rb') as primary_file:
+        checksum = hashlib.sha256(primary_file.read()).hexdigest()
+    location = 'repodata/{0}-primary.xml.gz'.format(checksum)
+    os.rename(primary_path, os.path.join(repo_path, location))
+    with open(os.path.join(repodata_path, 'repomd.xml'), 'w') as repomd_file:
+        repomd_file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n'
+            '<data type="primary"><checksum type="sha256">{0}</checksum>'
+            '<location href="{1}"/></data>\n'
+            '</repomd>\n'.format(checksum, location))
+
+
+def generate_global_requirements(path, names, seed=0):
+    rnd = random.Random(seed)
+    with open(path, 'w') as greq_file:
+        for name in names:
+            greq_file.write("{0}>={1}.{2},!={1}.{3}  # Apache-2.0\n".format(
+                name, rnd.randint(0, 3), rnd.randint(0, 9), rnd.randint(10, 19)))
+
+
+def generate_pip_log(path, component, names, seed=0):
+    """
+    Writes 'pip install --verbose' output for a requirement tree over
+    'names', each package required by one of the packages before it.
+    """
+    rnd = random.Random(seed)
+    chains = []
+    with open(path, 'w') as log_file:
+        for i, name in enumerate(names):
+            requirement = "{0}>={1}.{2}".format(name, rnd.randint(0, 3), rnd.randint(0, 9))
+            chain = rnd.choice(chains) if i >= 10 else [component]
+            if len(chain) < 8:
+                chains.append([requirement] + chain)
+            if i % 3:
+                log_file.write("Downloading/unpacking {0} (from {1})\n".format(
+                    requirement, '->'.join(chain)))
+                log_file.write("  Running setup.py egg_info for package {0}\n".format(name))
+            else:
+                log_file.write(
+                    "Requirement already satisfied (use --upgrade to upgrade): "
+                    "{0} in /usr/lib/python2.7/dist-packages (from {1})\n".format(
+                        requirement, '->'.join(chain)))
+
+
+class FixtureRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves the fixture directory and answers conditional requests the way
+    repository mirrors do.
+    """
+    root = '.'
+
+    def translate_path(self, path):
+        return os.path.join(self.root, path.split('?')[0].lstrip('/'))
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        since = self.headers.getheader('If-Modified-Since')
+        if since and os.path.isfile(path) and parsedate_tz(since):
+            if int(os.path.getmtime(path)) <= mktime_tz(parsedate_tz(since)):
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_server(fixtures_path):
+    class Handler(FixtureRequestHandler):
+        root = fixtures_path
+
+    server = FixtureServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+class Quiet():
+    """
+    Silences the progress output of the measured code.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, type, value, tb):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+class Benchmark():
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, stage, func, setup=None):
+        """
+        Runs 'func' 'repeat' times, calling 'setup' untimed before each run.
+        Returns the result of the last run.
+        """
+        runs = []
+        for i in range(self.repeat):
+            with Quiet():
+                if setup:
+                    setup()
+                start = time.time()
+                result = func()
+                runs.append(time.time() - start)
+        runs.sort()
+        self.results[stage] = {
+            'runs': runs,
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+            'max': runs[-1]
+        }
+        # Progress goes to stderr, stdout may carry the JSON results
+        sys.stderr.write("{0:40}{1:10.4f} s\n".format(stage, runs[0]))
+        return result
+
+
+def run(args, work_dir):
+    fixtures_path = os.path.join(work_dir, 'www')
+    cache_root = os.path.join(work_dir, 'cache')
+    os.makedirs(os.path.join(fixtures_path, 'deb'))
+    os.makedirs(cache_root)
+
+    projects = python_names(args.requirements)
+    packages = distro_names(args.stanzas, projects)
+    generate_packages_gz(os.path.join(fixtures_path, 'deb', 'Packages.gz'), packages)
+    generate_rpm_repository(os.path.join(fixtures_path, 'rpm'), packages)
+    generate_global_requirements(
+        os.path.join(fixtures_path, 'global-requirements.txt'), projects)
+    log_path = os.path.join(work_dir, 'pip.log')
+    generate_pip_log(log_path, 'murano', projects)
+
+    server, base_url = start_server(fixtures_path)
+    bench = Benchmark(args.repeat)
+
+    def clean_cache():
+        shutil.rmtree(cache_root, True)
+
+    def repository(cls, path, threshold=60 * 60):
+        repo = cls('bench-{0}'.format(path))
+        repo.repo_url = '/'.join([base_url, path])
+        repo.cache_root = cache_root
+        repo.cache_threshold_sec = threshold
+        repo.update_cache()
+        if repo.broken:
+            raise Exception("Repository '{0}' is broken".format(repo.repo_url))
+        return repo
+
+    try:
+        for cls, path in ((pd.PackageRepositoryDeb, 'deb'), (pd.PackageRepositoryRpm, 'rpm')):
+            bench.measure(path + '.update_cache.cold',
+                          lambda: repository(cls, path), setup=clean_cache)
+            bench.measure(path + '.update_cache.warm', lambda: repository(cls, path))
+            repo = bench.measure(path + '.update_cache.revalidate',
+                                 lambda: repository(cls, path, threshold=0))
+            bench.measure(path + '.grep_package',
+                          lambda: [repo.grep_package(n) for n in projects])
+            bench.measure(path + '.grep_many', lambda: repo.grep_many(projects))
+
+        greq_url = '/'.join([base_url, 'global-requirements.txt'])
+        greq = bench.measure(
+            'global_requirements.load',
+            lambda: pd.GlobalRequirements(greq_url, cache_root=cache_root),
+            setup=lambda: shutil.rmtree(pd.cache_dir_for(greq_url, cache_root), True))
+
+        with open(log_path) as log_file:
+            log_lines = log_file.readlines()
+
+        def parse_log():
+            reqs = pd.RequirementsResolver(method='pip')
+            reqs.package_name = 'murano'
+            reqs.parse_pip_output(log_lines)
+            return reqs
+        reqs = bench.measure('resolver.parse_pip_output', parse_log)
+
+        validation_result = bench.measure('global_requirements.validate',
+                                          lambda: reqs.validate(greq))
+
+        repo_set = pd.PackageRepositorySet(cache_root=cache_root)
+        with Quiet():
+            repo_set.add(repository(pd.PackageRepositoryDeb, 'deb'), refresh=False)
+            repo_set.add(repository(pd.PackageRepositoryRpm, 'rpm'), refresh=False)
+            repo_set.refresh(jobs=1)
+
+        report = pd.ReportGenerator(package_name='murano')
+        bench.measure('report.machine_friendly',
+                      lambda: report.machine_friendly_report(validation_result=validation_result))
+        bench.measure('report.package_matching',
+                      lambda: report.package_matching(validation_result=validation_result,
+                                                      repository_set=repo_set))
+
+        def whole_repository_set():
+            graph = pd.DistroDependencyGraph(repo_set.repository_list)
+            return graph.closure(list(graph.nodes))
+        bench.measure('closure.whole_repository_set', whole_repository_set)
+        bench.measure('report.dependency_closure',
+                      lambda: report.dependency_closure(validation_result=validation_result,
+                                                        repository_set=repo_set))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'parameters': {
+            'stanzas': args.stanzas,
+            'requirements': args.requirements,
+            'repeat': args.repeat,
+            'log_lines': len(log_lines)
+        },
+        'results': bench.results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--stanzas', type=int, default=50000,
+                        help='Number of packages in the synthetic repositories.')
+    parser.add_argument('--requirements', type=int, default=1000,
+                        help='Number of Python projects in global requirements '
+                             'and in the resolver log.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs per stage, the fastest one is reported.')
+    parser.add_argument('--output', default=None,
+                        help='Write results as JSON to this file instead of stdout.')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory for fixtures and caches, removed afterwards.')
+    args = parser.parse_args()
+
+    work_dir = mkdtemp(prefix='bench-', dir=args.work_dir)
+    try:
+        result = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
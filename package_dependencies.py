@@ -1,59 +1,854 @@
 #!/usr/bin/env python2
 
 import urllib2
+import urlparse
 import re
 import os
+import io
+import gzip
+import bz2
+import zlib
+import errno
+import fcntl
+import hashlib
+import cPickle as pickle
+import json
+import mmap
+import shutil
+import operator
+import tarfile
+import zipfile
+import ConfigParser
+import pkg_resources
+from collections import OrderedDict, deque
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 from pushd import pushd
 from getpass import getuser
+from tempfile import mkdtemp
 
 from sh import python
 from sh import tail
 from sh import pip
-from sh import rm, mkdir
+from sh import rm
 from sh import git
-from uuid import uuid4
+from sh import ErrorReturnCode
 
-from tempfile import mkdtemp
-from sh import grep_dctrl
-from sh import repoquery
-from sh import wget
-from sh import awk
-from sh import zcat
 import os.path, time
 from lxml import etree
 
 import argparse
+import cProfile
+import csv
+import heapq
+import bisect
+import sys
+from xml.sax.saxutils import escape as xml_escape, quoteattr
+
+# Instrumentation
+#================
+
+
+class StageContext:
+    def __init__(self, metrics, name, scope):
+        self.metrics = metrics
+        self.name = name
+        self.scope = scope
+
+    def __enter__(self):
+        self.start = time.time()
+        self.metrics._stack().append(self.name)
+        return self
+
+    def __exit__(self, type, value, tb):
+        elapsed = time.time() - self.start
+        self.metrics._stack().pop()
+        with self.metrics._lock:
+            stage = self.metrics.stages.setdefault(
+                self.name, OrderedDict([('wall_time', 0.0), ('calls', 0)]))
+            stage['wall_time'] += elapsed
+            stage['calls'] += 1
+            if self.scope:
+                counters = self.metrics.scopes.setdefault(self.scope, {})
+                counters['wall_time'] = counters.get('wall_time', 0.0) + elapsed
+
+
+class Metrics():
+    """
+    Run statistics: wall time of named stages and counters (downloads,
+    subprocesses, cache hits and misses, lookups), each counted in total,
+    for the innermost stage running in the current thread and for an
+    optional scope such as a repository name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.scopes = OrderedDict()
+        self.totals = {}
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def stage(self, name, scope=None):
+        """
+        Returns a context manager timing a stage. Wall time of a stage
+        entered with a scope is also added to that scope.
+        """
+        return StageContext(self, name, scope)
+
+    def count(self, counter, value=1, scope=None):
+        stack = self._stack()
+        with self._lock:
+            self.totals[counter] = self.totals.get(counter, 0) + value
+            if stack:
+                stage = self.stages.setdefault(
+                    stack[-1], OrderedDict([('wall_time', 0.0), ('calls', 0)]))
+                stage[counter] = stage.get(counter, 0) + value
+            if scope:
+                counters = self.scopes.setdefault(scope, {})
+                counters[counter] = counters.get(counter, 0) + value
+
+    def merge(self, data):
+        """
+        Adds the figures of another run, as returned by as_dict().
+        """
+        with self._lock:
+            for target, source in ((self.stages, data['stages']),
+                                   (self.scopes, data['scopes'])):
+                for name, counters in source.items():
+                    target_counters = target.setdefault(name, OrderedDict())
+                    for counter, value in counters.items():
+                        target_counters[counter] = target_counters.get(counter, 0) + value
+            for counter, value in data['totals'].items():
+                self.totals[counter] = self.totals.get(counter, 0) + value
+
+    def as_dict(self):
+        with self._lock:
+            return OrderedDict([
+                ('wall_time', time.time() - self.started),
+                ('totals', dict(self.totals)),
+                ('stages', OrderedDict(
+                    (name, dict(counters)) for name, counters in self.stages.items())),
+                ('scopes', OrderedDict(
+                    (name, dict(counters)) for name, counters in self.scopes.items()))
+            ])
+
+    def save(self, path):
+        with open(path, 'w') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2)
+
+
+METRICS = Metrics()
+
+
+def counted_command(name, command):
+    """
+    Wraps an 'sh' command so that each launch is counted.
+    """
+    def run(*args, **kwargs):
+        METRICS.count('subprocesses', scope='command:' + name)
+        return command(*args, **kwargs)
+    return run
+
+
+python = counted_command('python', python)
+tail = counted_command('tail', tail)
+pip = counted_command('pip', pip)
+rm = counted_command('rm', rm)
+git = counted_command('git', git)
+
+
+#================
+
 
 # package_repository classes
 #===========================
 
+# Absolute, as resolving requirements changes the working directory
+DEFAULT_CACHE_ROOT = os.path.abspath(os.environ.get(
+    'MURANO_SCRIPTS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'murano-scripts')
+))
+
+
+def cache_dir_for(url, cache_root=None):
+    """
+    Returns a stable cache directory for the given URL. The same URL always
+    maps to the same directory, so the cache is shared by all runs on a host.
+    """
+    cache_root = cache_root if cache_root else DEFAULT_CACHE_ROOT
+    return os.path.join(cache_root, hashlib.sha1(url).hexdigest())
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class CacheLockContext:
+    # Locks held by the current thread, lock path -> (lock file, depth).
+    # flock() on a second descriptor of the same file blocks even within
+    # one process, so nested locking of a directory reuses the held lock.
+    _held = threading.local()
+
+    def __init__(self, path, name='.lock'):
+        self.path = os.path.abspath(path)
+        self.lock_path = os.path.join(self.path, name)
+
+    def __enter__(self):
+        held = self._held.__dict__
+        if self.lock_path in held:
+            lock_file, depth = held[self.lock_path]
+            held[self.lock_path] = (lock_file, depth + 1)
+            return self
+        ensure_dir(self.path)
+        lock_file = open(self.lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held[self.lock_path] = (lock_file, 1)
+        return self
+
+    def __exit__(self, type, value, tb):
+        held = self._held.__dict__
+        lock_file, depth = held[self.lock_path]
+        if depth > 1:
+            held[self.lock_path] = (lock_file, depth - 1)
+            return
+        del held[self.lock_path]
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def cache_lock(path, name='.lock'):
+    """
+    Holds an exclusive lock on a cache directory, so that concurrent runs
+    do not download into or read from a half-written cache. Caches of many
+    independent files lock each file by its own lock 'name' instead.
+    """
+    return CacheLockContext(path, name)
+
+
+def http_validators(path):
+    """
+    Returns the ETag / Last-Modified values stored for a cached file.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + '.http') as validators_file:
+            return json.load(validators_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def mark_validated(path):
+    """
+    Records that a cached file was just confirmed to be up-to-date.
+    """
+    os.utime(path + '.http', None)
+
+
+def cache_file_age(path):
+    """
+    Returns seconds since a cached file was downloaded or last confirmed to
+    be up-to-date.
+    """
+    # The validators file is touched on every successful revalidation,
+    # the cached file only when its content changes.
+    stamp_path = path + '.http'
+    if not os.path.exists(stamp_path):
+        stamp_path = path
+    return time.time() - os.path.getmtime(stamp_path)
+
+
+def http_fetch(url, path, validators=None, timeout=60, scope=None):
+    """
+    Downloads 'url' to 'path', sending a conditional request if validators
+    of a previous download are given. Requests and downloaded bytes are
+    counted in METRICS under 'scope'.
+
+    Returns False if the server answered '304 Not Modified' (nothing is
+    written in that case), True if new content was stored.
+    """
+    METRICS.count('http_requests', scope=scope)
+    request = urllib2.Request(url)
+    if validators:
+        if validators.get('etag'):
+            request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            request.add_header('If-Modified-Since', validators['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            METRICS.count('http_not_modified', scope=scope)
+            return False
+        raise
+
+    try:
+        with open(path + '.part', 'wb') as part_file:
+            shutil.copyfileobj(response, part_file, 1024 * 1024)
+        METRICS.count('bytes_downloaded', os.path.getsize(path + '.part'), scope=scope)
+        headers = response.info()
+        validators = {
+            'url': url,
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified')
+        }
+    finally:
+        response.close()
+
+    os.rename(path + '.part', path)
+    with open(path + '.http', 'w') as validators_file:
+        json.dump(validators, validators_file)
+    return True
+
+
+RPM_COMMON_NS = 'http://linux.duke.edu/metadata/common'
+RPM_FILELISTS_NS = 'http://linux.duke.edu/metadata/filelists'
+RPM_NS = 'http://linux.duke.edu/metadata/rpm'
+
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+
+def is_literal(name):
+    return not REGEX_METACHARACTERS.intersection(name)
+
+
+def dash_suffixes(name):
+    """
+    Yields 'name' and every part of it that follows a dash, i.e. all the
+    strings that '(^|-)<suffix>$' would match in it.
+    """
+    yield name
+    position = name.find('-')
+    while position != -1:
+        yield name[position + 1:]
+        position = name.find('-', position + 1)
+
+
+def open_compressed(path):
+    """
+    Opens a possibly compressed metadata file for buffered reading.
+    """
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path))
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    return open(path, 'rb')
+
+
+def parse_rpm_primary(path):
+    """
+    Yields (name, epoch, version, release, arch) tuples from a repository
+    primary.xml file, parsing it incrementally so that memory use does not
+    depend on the file size.
+    """
+    package_tag = '{{{0}}}package'.format(RPM_COMMON_NS)
+    name_tag = '{{{0}}}name'.format(RPM_COMMON_NS)
+    version_tag = '{{{0}}}version'.format(RPM_COMMON_NS)
+    arch_tag = '{{{0}}}arch'.format(RPM_COMMON_NS)
+
+    with open_compressed(path) as primary_file:
+        for event, element in etree.iterparse(primary_file, events=('end',),
+                                              tag=package_tag):
+            version = element.find(version_tag)
+            yield (
+                element.findtext(name_tag),
+                version.get('epoch', '0'),
+                version.get('ver'),
+                version.get('rel'),
+                element.findtext(arch_tag)
+            )
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def parse_repomd(path):
+    """
+    Returns a dict of metadata type -> (location, checksum) from repomd.xml.
+    """
+    xmlroot = etree.parse(path).getroot()
+    xmlns = xmlroot.nsmap[None]
+    metadata = {}
+    for item in xmlroot.findall("{{{0}}}data".format(xmlns)):
+        checksum = item.findtext("{{{0}}}checksum".format(xmlns))
+        for subitem in item.findall("{{{0}}}location".format(xmlns)):
+            metadata[item.get('type')] = (subitem.get('href'), checksum)
+    return metadata
+
+
+def parse_deb_index(path, output_path):
+    """
+    Yields (package, version, offset) for every stanza of a gzipped Debian
+    'Packages' index, writing the decompressed index to 'output_path' on
+    the way. 'offset' is where the stanza starts in the decompressed file.
+    """
+    package = version = None
+    offset = start = 0
+    with io.BufferedReader(gzip.open(path)) as index_file, \
+            open(output_path, 'wb') as output_file:
+        for line in index_file:
+            output_file.write(line)
+            if not line.strip():
+                if package and version:
+                    yield package, version, start
+                package = version = None
+                start = offset + len(line)
+            elif line.startswith('Package:'):
+                package = line[8:].strip()
+            elif line.startswith('Version:'):
+                version = line[8:].strip()
+            offset += len(line)
+    if package and version:
+        yield package, version, start
+
+
+def parse_deb_stanza(stanza):
+    """
+    Returns an OrderedDict of field -> value for a Debian control stanza.
+    Continuation lines are kept, joined to the value with newlines.
+    """
+    fields = OrderedDict()
+    field = None
+    for line in stanza.splitlines():
+        if line[:1] in (' ', '\t'):
+            if field:
+                fields[field] += '\n' + line.strip()
+            continue
+        field, _, value = line.partition(':')
+        fields[field] = value.strip()
+    return fields
+
+
+DEB_RELATION_FIELDS = ('Depends', 'Pre-Depends', 'Provides', 'Conflicts', 'Breaks')
+DEB_RELATION_RE = re.compile(
+    r'^\s*([^\s:(\[<]+)(?::\S+)?\s*(?:\(\s*([<>=]+)\s*([^)\s]+)\s*\))?')
+DEB_RELATION_OPERATORS = {
+    '<<': 'lt', '<=': 'le', '=': 'eq', '>=': 'ge', '>>': 'gt',
+    # Obsolete forms, meaning '<=' and '>='
+    '<': 'le', '>': 'ge'
+}
+RPM_RELATION_OPERATORS = {'LT': 'lt', 'LE': 'le', 'EQ': 'eq', 'GE': 'ge', 'GT': 'gt'}
+
+
+def parse_deb_relations_index(lines):
+    """
+    Yields (package, version, fields) for every stanza of the lines of a
+    decompressed Debian 'Packages' index in one sequential pass. 'fields'
+    holds only the relationship fields, other lines are not split.
+    """
+    package = version = field = None
+    fields = {}
+    for line in lines:
+        if line[:1] in (' ', '\t'):
+            if field:
+                fields[field] += ' ' + line.strip()
+            continue
+        if not line.strip():
+            if package and version:
+                yield package, version, fields
+            package = version = field = None
+            fields = {}
+            continue
+        name, _, value = line.partition(':')
+        field = None
+        if name == 'Package':
+            package = value.strip()
+        elif name == 'Version':
+            version = value.strip()
+        elif name in DEB_RELATION_FIELDS:
+            field = name
+            fields[name] = value.strip()
+    if package and version:
+        yield package, version, fields
+
+
+def parse_deb_relations(field, version_keys):
+    """
+    Parses a Debian relationship field ('a (>= 1.0) | b, c:any') into a
+    tuple of (text, alternatives) groups, each alternative being
+    (name, operator, version key). 'version_keys' memoizes version keys
+    between calls.
+    """
+    groups = []
+    for text in field.split(','):
+        alternatives = []
+        for alternative in text.split('|'):
+            match = DEB_RELATION_RE.match(alternative)
+            if not match:
+                continue
+            name, op, version = match.groups()
+            if version and version not in version_keys:
+                version_keys[version] = deb_version_key(version)
+            alternatives.append((
+                name,
+                DEB_RELATION_OPERATORS.get(op) if version else None,
+                version_keys[version] if version else None
+            ))
+        if alternatives:
+            groups.append((text.strip(), tuple(alternatives)))
+    return tuple(groups)
+
+
+def rpm_relation(entry):
+    """
+    Returns (text, (name, operator, version key)) for an rpm:entry element.
+    Without a release, the key only covers epoch and version, so that it
+    matches any release.
+    """
+    name = entry.get('name')
+    op = RPM_RELATION_OPERATORS.get(entry.get('flags'))
+    if not op or entry.get('ver') is None:
+        return name, (name, None, None)
+    epoch, version, release = entry.get('epoch', '0'), entry.get('ver'), entry.get('rel')
+    if release:
+        key = rpm_version_key(epoch, version, release)
+        text = "{0} {1} {2}-{3}".format(name, entry.get('flags'), version, release)
+    else:
+        key = (int(epoch or 0), rpm_string_key(version))
+        text = "{0} {1} {2}".format(name, entry.get('flags'), version)
+    return text, (name, op, key)
+
+
+def parse_rpm_relations(path):
+    """
+    Yields (name, epoch, version, release, requires, provides, conflicts)
+    for every package of a repository primary.xml file. Relations are
+    lists of rpm_relation() results; the files listed in primary.xml are
+    returned as unversioned provides.
+    """
+    package_tag = '{{{0}}}package'.format(RPM_COMMON_NS)
+    name_tag = '{{{0}}}name'.format(RPM_COMMON_NS)
+    version_tag = '{{{0}}}version'.format(RPM_COMMON_NS)
+    format_tag = '{{{0}}}format'.format(RPM_COMMON_NS)
+    file_tag = '{{{0}}}file'.format(RPM_COMMON_NS)
+    entry_tag = '{{{0}}}entry'.format(RPM_NS)
+    relation_tags = dict(
+        ('{{{0}}}{1}'.format(RPM_NS, relation), relation)
+        for relation in ('requires', 'provides', 'conflicts')
+    )
+
+    with open_compressed(path) as primary_file:
+        for event, element in etree.iterparse(primary_file, events=('end',),
+                                              tag=package_tag):
+            version = element.find(version_tag)
+            relations = {'requires': [], 'provides': [], 'conflicts': []}
+            package_format = element.find(format_tag)
+            if package_format is not None:
+                for item in package_format:
+                    if item.tag in relation_tags:
+                        relations[relation_tags[item.tag]].extend(
+                            rpm_relation(entry) for entry in item.iter(entry_tag)
+                            if not entry.get('name', '').startswith('rpmlib('))
+                    elif item.tag == file_tag and item.text:
+                        relations['provides'].append((item.text, (item.text, None, None)))
+            yield (
+                element.findtext(name_tag),
+                version.get('epoch', '0'),
+                version.get('ver'),
+                version.get('rel'),
+                relations['requires'],
+                relations['provides'],
+                relations['conflicts']
+            )
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def parse_deb_contents(path):
+    """
+    Yields (path, [package, ...]) for the Python module paths listed in a
+    gzipped Debian 'Contents' index, reading it line by line. Other lines
+    are skipped without being split.
+    """
+    with io.BufferedReader(gzip.open(path)) as contents_file:
+        for line in contents_file:
+            # Every Python module path has a '/py...' component
+            if '/py' not in line:
+                continue
+            fields = line.rsplit(None, 1)
+            if len(fields) != 2:
+                continue
+            yield fields[0], [
+                location.rsplit('/', 1)[-1] for location in fields[1].split(',')
+            ]
+
+
+def parse_rpm_filelists(path):
+    """
+    Yields (name, [path, ...]) for every package of a repository
+    filelists.xml file, parsing it incrementally.
+    """
+    package_tag = '{{{0}}}package'.format(RPM_FILELISTS_NS)
+    file_tag = '{{{0}}}file'.format(RPM_FILELISTS_NS)
+
+    with open_compressed(path) as filelists_file:
+        for event, element in etree.iterparse(filelists_file, events=('end',),
+                                              tag=package_tag):
+            yield element.get('name'), [
+                item.text for item in element.iter(file_tag) if item.text
+            ]
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+PYTHON_MODULE_PATH_RE = re.compile(
+    r'(?:^|/)(?:site-packages|dist-packages|pyshared|pymodules/python[\d.]+)/([^/]+)')
+PYTHON_MODULE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def python_module_for_path(path):
+    """
+    Returns ('project', name) for egg-info / dist-info paths and
+    ('module', name) for top-level modules and packages installed under
+    site-packages or dist-packages, None for any other path.
+    """
+    match = PYTHON_MODULE_PATH_RE.search(path)
+    if not match:
+        return None
+    entry = match.group(1)
+    for suffix in ('.egg-info', '.dist-info', '.egg'):
+        if entry.endswith(suffix):
+            # <project>[-<version>[-py<X.Y>]].egg-info
+            return 'project', normalize_name(entry[:-len(suffix)].split('-', 1)[0])
+    name = entry.split('.', 1)[0] if entry.endswith(('.py', '.so')) else entry
+    # Private modules such as '_yaml' or '__pycache__' are not requirements
+    if not PYTHON_MODULE_NAME_RE.match(name) or name.startswith('_'):
+        return None
+    return 'module', normalize_name(name)
+
+
+class ModuleMapBuilder():
+    """
+    Collects the packages shipping each Python project (egg-info) and
+    top-level module while file lists are streamed through it.
+    """
+    def __init__(self):
+        self.projects = {}
+        self.modules = {}
+        self._packages = {}
+
+    def add(self, path, packages):
+        found = python_module_for_path(path)
+        if not found:
+            return
+        kind, name = found
+        names = self.projects if kind == 'project' else self.modules
+        shipped_by = names.setdefault(name, set())
+        for package in packages:
+            # The same few thousand package names repeat on every line
+            shipped_by.add(self._packages.setdefault(package, package))
+
+    def result(self):
+        return (
+            dict((name, tuple(sorted(p))) for name, p in self.projects.items()),
+            dict((name, tuple(sorted(p))) for name, p in self.modules.items())
+        )
+
+
 class PackageRepository():
     def __init__(self, name):
         self.name = name
         self.base_url = ''
         self.repo_url = ''
         self.index_file = ''
-        self.cache_dir = mkdtemp()
-        self.cache_uuid = uuid4()
+        self.index_format = 1
+        self.version_scheme = None
+        self.cache_root = DEFAULT_CACHE_ROOT
+        self.cache_dir = ''
         self.cache_threshold_sec = 60 * 60
+        self.http_timeout = 60
         self.broken = False
+        self.package_names = []
+        self.package_index = {}
+        self._match_cache = {}
+        # Python project / module name -> packages shipping it, built
+        # from the repository file lists by update_module_map()
+        self.build_module_map = False
+        self.module_map_format = 1
+        self.module_projects = {}
+        self.module_names = {}
         print("")
         print("Caching data for repository '{0}'".format(name))
 
     def grep_package(self, name, pattern=None):
         pass
 
+    def grep_exact(self, name):
+        """
+        Returns [name, version] pairs of the package named exactly 'name'.
+        """
+        pass
+
+    def grep_many(self, names, pattern=None):
+        """
+        Looks up several names at once. Returns a dict of name -> list of
+        [name, version] pairs, the same as grep_package returns for each.
+        """
+        return dict(
+            (name, self.grep_package(name, pattern=pattern)) for name in names
+        )
+
+    def match_names(self, expression, flags=0):
+        """
+        Returns indexed package names matching the regular expression,
+        in index order. Results are memoized per expression.
+        """
+        METRICS.count('match_cache_hits' if expression in self._match_cache
+                      else 'match_cache_misses', scope=self.name)
+        if expression not in self._match_cache:
+            try:
+                regex = re.compile(expression, flags)
+            except re.error:
+                return []
+            self._match_cache[expression] = [
+                p for p in self.package_names if regex.search(p)
+            ]
+        return self._match_cache[expression]
+
+    def load_index(self):
+        pass
+
+    def index_cache_path(self):
+        return os.path.join(self.cache_dir, self.index_file) + '.index'
+
+    def read_saved_index(self):
+        """
+        Returns the parsed index stored next to the raw index file, or None
+        if there is no saved index or it is older than the raw file.
+        """
+        index_file_path = os.path.join(self.cache_dir, self.index_file)
+        saved_index_path = self.index_cache_path()
+        data = None
+        if os.path.exists(saved_index_path) and \
+                os.path.getmtime(saved_index_path) >= os.path.getmtime(index_file_path):
+            try:
+                with open(saved_index_path, 'rb') as saved_index:
+                    index_format, data = pickle.load(saved_index)
+            except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+                index_format = None
+            if index_format != self.index_format:
+                data = None
+        METRICS.count('saved_index_hits' if data else 'saved_index_misses',
+                      scope=self.name)
+        return data
+
+    def save_index(self, data):
+        saved_index_path = self.index_cache_path()
+        with open(saved_index_path + '.part', 'wb') as saved_index:
+            pickle.dump((self.index_format, data), saved_index,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(saved_index_path + '.part', saved_index_path)
+
+    def module_map_path(self):
+        return os.path.join(self.cache_dir, 'modules.index')
+
+    def read_module_map(self, source):
+        """
+        Loads the saved module map if it was built from 'source', an
+        identifier of the scanned file list. Returns True on success.
+        """
+        try:
+            with open(self.module_map_path(), 'rb') as saved_map:
+                map_format, map_source, projects, modules = pickle.load(saved_map)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            map_format = map_source = None
+        if map_format != self.module_map_format or map_source != source:
+            METRICS.count('module_map_misses', scope=self.name)
+            return False
+        METRICS.count('module_map_hits', scope=self.name)
+        self.module_projects, self.module_names = projects, modules
+        return True
+
+    def save_module_map(self, source, builder):
+        self.module_projects, self.module_names = builder.result()
+        saved_map_path = self.module_map_path()
+        with open(saved_map_path + '.part', 'wb') as saved_map:
+            pickle.dump((self.module_map_format, source,
+                         self.module_projects, self.module_names),
+                        saved_map, pickle.HIGHEST_PROTOCOL)
+        os.rename(saved_map_path + '.part', saved_map_path)
+        print("Done. {0} Python projects and {1} modules mapped to packages.".format(
+            len(self.module_projects), len(self.module_names)))
+
+    def update_module_map(self):
+        pass
+
+    def package_fields(self, name, version=None):
+        """
+        Returns an OrderedDict of the index fields (Depends, Source, ...)
+        of the given version of a package, of its first indexed version if
+        'version' is None. Empty if the repository keeps no such fields.
+        """
+        return OrderedDict()
+
+    def package_relations(self):
+        """
+        Returns (package, version, version key, depends, provides, conflicts)
+        for every indexed package version, read in one pass over the
+        repository metadata. 'depends' is a list of (text, alternatives)
+        groups, 'provides' a list of (name, version key or None) and
+        'conflicts' a list of (text, (name, operator, version key)).
+        """
+        return []
+
+    def mapped_packages(self, names):
+        """
+        Returns a dict of name -> packages of this repository shipping the
+        Python project (or, failing that, the top-level module) 'name',
+        for the names found in the module map.
+        """
+        mapped = {}
+        for name in names:
+            key = normalize_name(name)
+            packages = [
+                p for p in self.module_projects.get(key) or self.module_names.get(key, ())
+                if p in self.package_index
+            ]
+            if packages:
+                mapped[name] = packages
+        return mapped
+
+    def download(self, url, path, validators=None):
+        """
+        Downloads a file next to its final location and moves it in place,
+        so a cached file is either the old one or a complete new one.
+
+        Returns False if the remote file was not modified since the
+        download described by 'validators'.
+        """
+        return http_fetch(url, path, validators=validators,
+                          timeout=self.http_timeout, scope=self.name)
+
     def test_cache(self):
         index_file_path = os.path.join(self.cache_dir, self.index_file)
         if os.path.exists(index_file_path):
-            file_age = time.time() - os.path.getctime(index_file_path)
+            file_age = cache_file_age(index_file_path)
             if file_age > self.cache_threshold_sec:
                 print("File '{0}' too old.".format(index_file_path))
+                METRICS.count('cache_misses', scope=self.name)
                 return False
         else:
             print("No such file '{0}'".format(index_file_path))
+            METRICS.count('cache_misses', scope=self.name)
             return False
 
+        METRICS.count('cache_hits', scope=self.name)
         print("Cache is up-to-date (index file updated {0} sec ago).".format(file_age))
         return True
 
@@ -74,115 +869,473 @@ class PackageRepositoryDeb(PackageRepository):
     def __init__(self, name):
         PackageRepository.__init__(self, name=name)
         self.index_file = 'Packages.gz'
+        self.index_format = 3
+        self.version_scheme = 'deb'
+        # Lower-cased dash-delimited suffix -> package names, in index order.
+        # Answers the default '(^|-)name$' match with a single probe.
+        self.suffix_index = {}
+        # The decompressed index is kept next to Packages.gz and mapped
+        # into memory on first use. Package name -> offsets of its stanzas,
+        # in the same order as the versions in package_index.
+        self.stanza_file = 'Packages'
+        self.stanza_index = {}
+        self._stanzas = None
+        # Contents index of the distribution, next to 'binary-amd64' by
+        # default. Subclasses set it where the layout differs.
+        self.contents_url = None
 
     def grep_package(self, name, pattern=None):
-        pattern = pattern if pattern else "(^|-){0}$"
-        try:
-            return [
-                line.rstrip().split(' ', 1)
-                for line in awk(
-                    grep_dctrl(
-                        zcat(os.path.join(self.cache_dir, self.index_file)),
-                        '-F', 'Package',
-                        '-e', pattern.format(name),
-                        '-s', 'Package,Version'
-                    ),
-                    '/Package/{p=$2;next} /Version/{print p " " $2}'
-                )
+        # Package names are matched case-insensitively, as 'grep-dctrl -i'
+        # does in get-pip-deps.sh.
+        METRICS.count('lookups', scope=self.name)
+        if not pattern and is_literal(name):
+            matched_names = self.suffix_index.get(name.lower(), [])
+        else:
+            pattern = pattern if pattern else "(^|-){0}$"
+            matched_names = self.match_names(pattern.format(name), re.IGNORECASE)
+        return [
+            [p, v]
+            for p in matched_names
+            for v in self.package_index[p]
+        ]
+
+    def grep_many(self, names, pattern=None):
+        """
+        Resolves names with the default pattern through the suffix index,
+        one probe per name.
+        """
+        if pattern:
+            return PackageRepository.grep_many(self, names, pattern=pattern)
+        return dict((name, self.grep_package(name)) for name in names)
+
+    def grep_exact(self, name):
+        METRICS.count('lookups', scope=self.name)
+        return [[name, v] for v in self.package_index.get(name, [])]
+
+    def stanza(self, name, version=None):
+        """
+        Returns the raw index stanza of the given version of a package, of
+        its first indexed version if 'version' is None. Only the bytes of
+        that stanza are read from the mapped index. Returns None if there
+        is no such package.
+        """
+        versions = self.package_index.get(name, [])
+        if version is None and versions:
+            version = versions[0]
+        if version not in versions or self._stanzas is None:
+            return None
+        offset = self.stanza_index[name][versions.index(version)]
+        end = self._stanzas.find('\n\n', offset)
+        return self._stanzas[offset:end + 1 if end != -1 else len(self._stanzas)]
+
+    def package_fields(self, name, version=None):
+        stanza = self.stanza(name, version)
+        return parse_deb_stanza(stanza) if stanza else OrderedDict()
+
+    def package_relations(self):
+        relations = []
+        # The same fields repeat across thousands of stanzas
+        version_keys = {}
+        parsed = {}
+
+        def parse(field):
+            if field not in parsed:
+                parsed[field] = parse_deb_relations(field, version_keys)
+            return parsed[field]
+
+        if self._stanzas is None:
+            return relations
+        self._stanzas.seek(0)
+        for package, version, fields in parse_deb_relations_index(
+                iter(self._stanzas.readline, '')):
+            depends = parse(fields.get('Pre-Depends', '')) + parse(fields.get('Depends', ''))
+            provides = [
+                (name, key)
+                for text, alternatives in parse(fields.get('Provides', ''))
+                for name, op, key in alternatives
             ]
-        except:
-            return []
+            conflicts = [
+                (text, alternative)
+                for field in ('Conflicts', 'Breaks')
+                for text, alternatives in parse(fields.get(field, ''))
+                for alternative in alternatives
+            ]
+            if version not in version_keys:
+                version_keys[version] = deb_version_key(version)
+            relations.append((package, version, version_keys[version],
+                              depends, provides, conflicts))
+        return relations
+
+    def _map_stanzas(self, stanza_file_path):
+        # Mapped while the cache lock is held, so the offsets always refer
+        # to this copy of the file even if another run replaces it later.
+        with open(stanza_file_path, 'rb') as stanza_file:
+            if os.fstat(stanza_file.fileno()).st_size:
+                self._stanzas = mmap.mmap(stanza_file.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+
+    def load_index(self):
+        """
+        Decompresses Packages.gz once and indexes it into name -> [versions]
+        and name -> [stanza offsets], keeping the order in which the
+        packages appear in the index file.
+        """
+        self._match_cache = {}
+        if self._stanzas is not None:
+            self._stanzas.close()
+            self._stanzas = None
+
+        stanza_file_path = os.path.join(self.cache_dir, self.stanza_file)
+        data = self.read_saved_index()
+        if data:
+            (self.package_names, self.package_index, self.suffix_index,
+             self.stanza_index, stanza_file_size) = data
+            if os.path.exists(stanza_file_path) and \
+                    os.path.getsize(stanza_file_path) == stanza_file_size:
+                self._map_stanzas(stanza_file_path)
+                print("Done. {0} packages loaded from saved index.".format(
+                    len(self.package_names)))
+                return
+
+        self.package_names = []
+        self.package_index = {}
+        self.suffix_index = {}
+        self.stanza_index = {}
+
+        index_file_path = os.path.join(self.cache_dir, self.index_file)
+        for package, version, offset in parse_deb_index(
+                index_file_path, stanza_file_path + '.part'):
+            if package not in self.package_index:
+                self.package_names.append(package)
+                self.package_index[package] = []
+                self.stanza_index[package] = ()
+                for suffix in dash_suffixes(package.lower()):
+                    self.suffix_index.setdefault(suffix, []).append(package)
+            self.package_index[package].append(version)
+            self.stanza_index[package] += (offset,)
+        os.rename(stanza_file_path + '.part', stanza_file_path)
+        self.save_index((self.package_names, self.package_index, self.suffix_index,
+                         self.stanza_index, os.path.getsize(stanza_file_path)))
+        self._map_stanzas(stanza_file_path)
+
+        print("Done. {0} packages indexed.".format(len(self.package_names)))
 
     def update_cache(self):
-        if not self.test_cache():
-            rm(self.cache_dir, '-rf')
-            self.cache_dir = mkdtemp()
+        self.cache_dir = cache_dir_for(self.repo_url, self.cache_root)
+
+        with cache_lock(self.cache_dir):
+            if not self.test_cache():
+                index_file_url = '/'.join([self.repo_url, self.index_file])
+                index_file_path = os.path.join(self.cache_dir, self.index_file)
 
-            index_file_url = '/'.join([self.repo_url, self.index_file])
-            index_file_path = os.path.join(self.cache_dir, self.index_file)
+                try:
+                    print("Downloading index file '{0}' --> '{1}' ...".format(
+                        index_file_url, index_file_path
+                    ))
+                    if not self.download(index_file_url, index_file_path,
+                                         http_validators(index_file_path)):
+                        print("Index file not modified, keeping cached copy.")
+                        mark_validated(index_file_path)
+                except:
+                    self.broken = True
+                    return
 
             try:
-                print("Downloading index file '{0}' --> '{1}' ...".format(
-                    index_file_url, index_file_path
-                ))
-                wget(index_file_url, '-O', index_file_path)
-            except:
+                self.load_index()
+            except (IOError, EOFError, zlib.error):
                 self.broken = True
 
+    def update_module_map(self):
+        """
+        Maps Python projects and modules to the packages shipping them by
+        streaming the Contents index. The index is revalidated like
+        Packages.gz and scanned again only when its content changed.
+        """
+        contents_url = self.contents_url
+        if not contents_url:
+            base_url = self.repo_url
+            if base_url.endswith('/binary-amd64'):
+                base_url = base_url.rsplit('/', 1)[0]
+            contents_url = '/'.join([base_url, 'Contents-amd64.gz'])
+        contents_path = os.path.join(self.cache_dir, 'Contents-amd64.gz')
+
+        with cache_lock(self.cache_dir):
+            if not os.path.exists(contents_path) or \
+                    cache_file_age(contents_path) > self.cache_threshold_sec:
+                try:
+                    print("Downloading contents file '{0}' --> '{1}' ...".format(
+                        contents_url, contents_path
+                    ))
+                    if not self.download(contents_url, contents_path,
+                                         http_validators(contents_path)):
+                        print("Contents file not modified, keeping cached copy.")
+                        mark_validated(contents_path)
+                except (urllib2.URLError, IOError) as e:
+                    print("Unable to download contents file: {0}".format(e))
+                    if not os.path.exists(contents_path):
+                        return
+
+            # The file is only replaced when it changes on the server
+            stat = os.stat(contents_path)
+            source = (stat.st_size, stat.st_mtime)
+            if self.read_module_map(source):
+                return
+
+            builder = ModuleMapBuilder()
+            for path, packages in parse_deb_contents(contents_path):
+                builder.add(path, packages)
+            self.save_module_map(source, builder)
+
 
 class PackageRepositoryRpm(PackageRepository):
     def __init__(self, name):
         PackageRepository.__init__(self, name=name)
         self.index_file = 'repodata/repomd.xml'
+        self.version_scheme = 'rpm'
+        # Metadata types downloaded on refresh, everything else listed in
+        # repomd.xml (filelists, other, comps, ...) is fetched on first use.
+        self.eager_metadata = ['primary']
+        self._metadata = None
+        # Lower-cased package names joined by newlines and the offset of
+        # each name in it, for substring search in a single string.
+        self._search_text = None
+        self._search_offsets = None
+        self._find_cache = {}
 
     def grep_package(self, name, pattern=None):
-        try:
-            package_list = []
-            found_items = [
-                line.rstrip()
-                for line in repoquery(
-                    "--repofrompath={0},{1}".format(self.cache_uuid, self.cache_dir),
-                    '--search', name)
-            ]
+        # Same semantics as 'repoquery --search': case-insensitive substring
+        # match on the package name.
+        if not pattern or pattern == "{0}":
+            return self.grep_many([name])[name]
+        METRICS.count('lookups', scope=self.name)
+        package_list = []
+        for p in self.match_names(pattern.format(re.escape(name)), re.IGNORECASE):
+            package_list.extend(self._version_pairs(p))
+        return package_list
+
+    def grep_exact(self, name):
+        METRICS.count('lookups', scope=self.name)
+        if name not in self.package_index:
+            return []
+        return self._version_pairs(name)
+
+    def _search_index(self):
+        if self._search_text is None:
+            offsets = []
+            offset = 0
+            for p in self.package_names:
+                offsets.append(offset)
+                offset += len(p) + 1
+            self._search_offsets = offsets
+            self._search_text = '\n'.join(self.package_names).lower()
+        return self._search_text, self._search_offsets
+
+    def grep_many(self, names, pattern=None):
+        """
+        Resolves names by searching all package names at once: they are
+        kept lower-cased in one newline separated string, so each name is
+        a single str.find() scan, with matches mapped back to packages by
+        their offsets.
+        """
+        if pattern and pattern != "{0}":
+            return PackageRepository.grep_many(self, names, pattern=pattern)
 
-            for item in found_items:
-                item_info = [
-                    line.rstrip()
-                    for line in repoquery(
-                        "--repofrompath={0},{1}".format(self.cache_uuid, self.cache_dir),
-                        '--info', item)
+        METRICS.count('lookups', len(names), scope=self.name)
+        result = {}
+        for name in names:
+            if name not in result:
+                result[name] = [
+                    pair
+                    for i in self._find_names(name.lower())
+                    for pair in self._version_pairs(self.package_names[i])
                 ]
+        return result
 
-                pkg_info = {}
-                for record in item_info:
-                    try:
-                        key, value = record.rstrip().split(':', 1)
-                        key = key.strip()
-                        value = value.strip()
-                        if key == 'Description':
-                            break
-                        pkg_info[key] = value
-                    except:
-                        continue
-                package_list.append([pkg_info['Name'], pkg_info['Version']])
-
-            return package_list
-        except:
-            return []
+    def _find_names(self, needle):
+        """
+        Returns positions of the package names containing 'needle', in
+        index order. Results are memoized per needle.
+        """
+        if needle not in self._find_cache:
+            found = []
+            text, offsets = self._search_index()
+            position = text.find(needle) if needle and '\n' not in needle else -1
+            while position != -1:
+                # Names hold no newline, so a match never spans two names
+                i = bisect.bisect_right(offsets, position) - 1
+                found.append(i)
+                if i + 1 == len(offsets):
+                    break
+                position = text.find(needle, offsets[i + 1])
+            self._find_cache[needle] = found
+        return self._find_cache[needle]
+
+    def _version_pairs(self, p):
+        pairs = []
+        versions = []
+        for epoch, version, release, arch in self.package_index[p]:
+            if version not in versions:
+                versions.append(version)
+                pairs.append([p, version])
+        return pairs
+
+    def package_relations(self):
+        relations = []
+        for name, epoch, version, release, requires, provides, conflicts in \
+                parse_rpm_relations(self.metadata_file('primary')):
+            relations.append((
+                name, version, rpm_version_key(epoch, version, release),
+                [(text, (relation,)) for text, relation in requires],
+                [(provided, key) for text, (provided, op, key) in provides],
+                conflicts
+            ))
+        return relations
+
+    def metadata_file(self, data_type):
+        """
+        Returns the local path of a metadata file of the given type
+        ('primary', 'filelists', 'other', ...), downloading it on first use.
+        Returns None if the repository does not provide that type.
+        """
+        if self._metadata is None:
+            self._metadata = parse_repomd(
+                os.path.join(self.cache_dir, self.index_file))
+        if data_type not in self._metadata:
+            return None
+
+        location, checksum = self._metadata[data_type]
+        path = os.path.join(self.cache_dir, 'repodata', os.path.basename(location))
+        if os.path.exists(path):
+            return path
+
+        with cache_lock(self.cache_dir):
+            if not os.path.exists(path):
+                url = '/'.join([self.repo_url, location])
+                print("Downloading file '{0}' --> '{1}' ...".format(url, path))
+                self.download(url, path)
+        return path
+
+    def load_index(self):
+        """
+        Parses primary.xml once into a name -> [(epoch, version, release,
+        arch)] index, keeping the order in which packages appear.
+        """
+        self._match_cache = {}
+        self._metadata = None
+        self._search_text = None
+        self._find_cache = {}
+
+        data = self.read_saved_index()
+        if data:
+            self.package_names, self.package_index = data
+            print("Done. {0} packages loaded from saved index.".format(
+                len(self.package_names)))
+            return
+
+        self.package_names = []
+        self.package_index = {}
+
+        primary_path = self.metadata_file('primary')
+        for name, epoch, version, release, arch in parse_rpm_primary(primary_path):
+            if name not in self.package_index:
+                self.package_names.append(name)
+                self.package_index[name] = []
+            self.package_index[name].append((epoch, version, release, arch))
+        self.save_index((self.package_names, self.package_index))
+
+        print("Done. {0} packages indexed.".format(len(self.package_names)))
 
     def update_cache(self):
-        if not self.test_cache():
-            rm(self.cache_dir, '-rf')
-            self.cache_dir = mkdtemp()
-            self.cache_uuid = uuid4()
-            mkdir(os.path.join(self.cache_dir, 'repodata'))
+        self.cache_dir = cache_dir_for(self.repo_url, self.cache_root)
 
-            index_file_url = '/'.join([self.repo_url, self.index_file])
-            index_file_path = os.path.join(self.cache_dir, self.index_file)
+        with cache_lock(self.cache_dir):
+            if not self.test_cache():
+                self.fetch_metadata()
+                if self.broken:
+                    return
 
             try:
-                print("Downloading index file '{0}' --> '{1}' ...".format(
-                    index_file_url, index_file_path
-                ))
-                wget(index_file_url, '-O', index_file_path)
-            except:
+                self.load_index()
+            except (IOError, EOFError, KeyError, zlib.error, etree.LxmlError):
                 self.broken = True
+
+    def update_module_map(self):
+        """
+        Maps Python projects and modules to the packages shipping them by
+        streaming filelists.xml. The map is keyed by the filelists checksum
+        from repomd.xml, so the file is neither downloaded nor scanned
+        again until the repository publishes a new one.
+        """
+        if self._metadata is None:
+            self._metadata = parse_repomd(
+                os.path.join(self.cache_dir, self.index_file))
+        if 'filelists' not in self._metadata:
+            print("Repository '{0}' provides no file lists.".format(self.name))
+            return
+
+        location, checksum = self._metadata['filelists']
+        source = checksum or location
+        if self.read_module_map(source):
+            return
+
+        builder = ModuleMapBuilder()
+        for name, paths in parse_rpm_filelists(self.metadata_file('filelists')):
+            for path in paths:
+                builder.add(path, [name])
+        with cache_lock(self.cache_dir):
+            self.save_module_map(source, builder)
+
+    def fetch_metadata(self):
+        # Metadata is fetched into a staging directory and swapped in
+        # only when complete, so the cache never mixes two snapshots.
+        repodata_path = os.path.join(self.cache_dir, 'repodata')
+        staging_path = repodata_path + '.new'
+        rm('-rf', staging_path)
+        ensure_dir(staging_path)
+
+        index_file_url = '/'.join([self.repo_url, self.index_file])
+        index_file_path = os.path.join(staging_path, 'repomd.xml')
+        cached_index_file_path = os.path.join(self.cache_dir, self.index_file)
+
+        try:
+            print("Downloading index file '{0}' --> '{1}' ...".format(
+                index_file_url, index_file_path
+            ))
+            if not self.download(index_file_url, index_file_path,
+                                 http_validators(cached_index_file_path)):
+                print("Index file not modified, keeping cached metadata.")
+                mark_validated(cached_index_file_path)
+                rm('-rf', staging_path)
                 return
+        except:
+            self.broken = True
+            return
 
-            try:
-                xmlroot = etree.parse(index_file_path).getroot()
-                xmlns = xmlroot.nsmap[None]
-                for item in xmlroot.findall("{{{0}}}data".format(xmlns)):
-                    for subitem in item.findall("{{{0}}}location".format(xmlns)):
-                        location = subitem.get('href')
-                        url = '/'.join([self.repo_url, location])
-                        path = '/'.join([self.cache_dir, location])
-                        print("Downloading file '{0}' --> '{1}' ...".format(
-                            url, path
-                        ))
-                        wget(url, '-O', path)
-            except:
-                self.broken = True
+        try:
+            metadata = parse_repomd(index_file_path)
+            for data_type, (location, checksum) in sorted(metadata.items()):
+                url = '/'.join([self.repo_url, location])
+                path = os.path.join(staging_path, os.path.basename(location))
+                # Files named after their checksum are immutable, so
+                # the copy from the previous snapshot can be reused.
+                cached_path = os.path.join(repodata_path, os.path.basename(location))
+                if checksum and checksum in os.path.basename(location) \
+                        and os.path.exists(cached_path):
+                    print("Reusing cached file '{0}' ...".format(cached_path))
+                    os.link(cached_path, path)
+                    continue
+                if data_type not in self.eager_metadata:
+                    continue
+                print("Downloading file '{0}' --> '{1}' ...".format(
+                    url, path
+                ))
+                self.download(url, path)
+        except:
+            self.broken = True
+            return
+
+        rm('-rf', repodata_path)
+        os.rename(staging_path, repodata_path)
 
 
 class MirantisInternalRepositoryDeb(PackageRepositoryDeb):
@@ -307,15 +1460,122 @@ class UpstreamPublicRepositoryDeb(PackageRepositoryDeb):
         self.fuel_type = fuel_type
         self.repo_url = "{0}/{1}/dists/{2}/main/binary-amd64".format(
             self.base_url, dist_name, dist_release)
+        self.contents_url = "{0}/{1}/dists/{2}/Contents-amd64.gz".format(
+            self.base_url, dist_name, dist_release)
+
+
+def _update_repository_cache(repository):
+    try:
+        with METRICS.stage('update_cache', scope=repository.name):
+            repository.update_cache()
+    except Exception as e:
+        print("Failed to update cache for repository '{0}': {1}".format(
+            repository.name, e))
+        repository.broken = True
+
+    if repository.build_module_map and not repository.broken:
+        # Without a module map names are still matched by pattern
+        try:
+            with METRICS.stage('module_map', scope=repository.name):
+                repository.update_module_map()
+        except Exception as e:
+            print("Failed to map Python modules for repository '{0}': {1}".format(
+                repository.name, e))
 
 
 class PackageRepositorySet():
-    def __init__(self):
+    def __init__(self, cache_root=None, module_maps=False):
         self.repository_list = []
-        self.custom_package_set = []
+        self.pending_list = []
+        self.custom_package_set = CustomPackageSet()
+        self.cache_root = os.path.abspath(cache_root) if cache_root else None
+        self.module_maps = module_maps
+        # Background lookups started by prefetch(), name -> AsyncResult
+        self._lookups = {}
+        self._lookup_queue = []
+        self._lookup_lock = threading.Lock()
+        self._lookup_pool = None
+        self._ready = False
+        self._dependency_graph = None
+
+    def add(self, repository, refresh=True):
+        """
+        Adds a repository to the set. With refresh=False the repository is
+        only queued, and its cache is updated by a later call to refresh().
+        """
+        # Caches may be refreshed in a background thread while requirements
+        # are resolved in another directory, so paths must be absolute.
+        if self.cache_root:
+            repository.cache_root = self.cache_root
+        repository.cache_root = os.path.abspath(repository.cache_root or DEFAULT_CACHE_ROOT)
+        repository.build_module_map = self.module_maps
+        self.pending_list.append(repository)
+        if refresh:
+            self.refresh(jobs=1)
+
+    def refresh(self, jobs=4):
+        """
+        Updates caches of all queued repositories using up to 'jobs' worker
+        threads, then registers them in the order they were added. Broken
+        repositories are skipped.
+        """
+        pending_list, self.pending_list = self.pending_list, []
+
+        jobs = max(1, min(jobs, len(pending_list)))
+        if jobs == 1:
+            for repository in pending_list:
+                _update_repository_cache(repository)
+        elif pending_list:
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(_update_repository_cache, pending_list)
+            finally:
+                pool.close()
+                pool.join()
+
+        for repository in pending_list:
+            self._register(repository)
 
-    def add(self, repository):
-        repository.update_cache()
+        with self._lookup_lock:
+            self._ready = True
+            for name in self._lookup_queue:
+                self._start_lookup(name)
+            self._lookup_queue = []
+
+    def prefetch(self, name):
+        """
+        Starts looking up 'name' in the background, so that the result is
+        ready when grep_many asks for it. Names prefetched before the
+        repositories are refreshed are looked up right after refresh().
+        Safe to call from any thread.
+        """
+        with self._lookup_lock:
+            if name in self._lookups or name in self._lookup_queue:
+                return
+            if self._ready:
+                self._start_lookup(name)
+            else:
+                self._lookup_queue.append(name)
+
+    def _start_lookup(self, name):
+        # Called with _lookup_lock held
+        if self._lookup_pool is None:
+            self._lookup_pool = ThreadPool(1)
+        self._lookups[name] = self._lookup_pool.apply_async(
+            self._grep_many, ([name],))
+
+    def close(self):
+        """
+        Waits for background lookups to finish and stops their worker.
+        """
+        with self._lookup_lock:
+            pool, self._lookup_pool = self._lookup_pool, None
+            self._lookups = {}
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _register(self, repository):
         if repository.broken:
             print("Repository '{0}' is broken.".format(repository.name))
             return
@@ -328,27 +1588,288 @@ class PackageRepositorySet():
             self.custom_package_set = custom_package_set
 
     def grep_package(self, name):
-        for repository in self.repository_list:
-            pattern = None
-            if name in self.custom_package_set:
-                name = self.custom_package_set.deb_package_for(name)
-                pattern = "{0}"
-            for p, v in repository.grep_package(name=name, pattern=pattern):
-                yield repository, p, v
+        for repository, p, v in self._grep_names([name])[name]:
+            yield repository, p, v
+
+    def grep_many(self, names):
+        """
+        Batch version of grep_package: resolves the whole list of names with
+        one query per repository. Returns an OrderedDict of
+        name -> [(repository, package, version)], ordered as 'names'.
+        Results of prefetched names are reused.
+        """
+        with self._lookup_lock:
+            lookups = dict(
+                (name, self._lookups[name]) for name in names if name in self._lookups
+            )
+        found = self._grep_many([name for name in names if name not in lookups])
+        for name, lookup in lookups.items():
+            found.update(lookup.get())
+        return OrderedDict((name, found[name]) for name in names)
+
+    def _grep_many(self, names):
+        with METRICS.stage('lookup'):
+            return self._grep_names(names)
+
+    def dependency_graph(self):
+        """
+        Returns the DistroDependencyGraph of all registered repositories,
+        built on first use.
+        """
+        if self._dependency_graph is None:
+            with METRICS.stage('dependency_graph'):
+                self._dependency_graph = DistroDependencyGraph(self.repository_list)
+        return self._dependency_graph
+
+    def _grep_names(self, names):
+        # Names with an alias, or found in the repository's module map, are
+        # looked up by their exact package names in each repository, the
+        # others with the repository's default search.
+        aliases = dict(
+            (repository, self.custom_package_set.aliases_for(names, repository))
+            for repository in self.repository_list
+        )
+
+        def grep_repository(repository):
+            packages = repository.mapped_packages(names)
+            packages.update(
+                (name, [package]) for name, package in aliases[repository].items())
+            found = repository.grep_many(
+                [name for name in names if name not in packages])
+            found.update(
+                (name, [pair for package in package_list
+                        for pair in repository.grep_exact(package)])
+                for name, package_list in packages.items())
+            return [found[name] for name in names]
+
+        # Lookups are in-memory index probes, threads would only contend
+        # for the GIL, so repositories are searched one after another.
+        repository_list = list(self.repository_list)
+        found = [grep_repository(r) for r in repository_list]
+
+        result = OrderedDict((name, []) for name in names)
+        for repository, pairs_list in zip(repository_list, found):
+            for name, pairs in zip(names, pairs_list):
+                result[name].extend((repository, p, v) for p, v in pairs)
+        return result
 
 
 #===========================
 
 
+# Distribution dependency closure
+#================================
+
+def relation_satisfied_by(provided_key, op, key):
+    """
+    Checks a provided version key against a relation. Unversioned
+    relations are satisfied by anything, versioned ones only by a
+    versioned provide.
+    """
+    if op is None:
+        return True
+    if provided_key is None:
+        return False
+    # RPM versions without a release match any release
+    length = min(len(provided_key), len(key))
+    return CONSTRAINT_OPERATORS[op](provided_key[:length], key[:length])
+
+
+class DependencyClosure():
+    """
+    Packages reachable from a set of root packages through their
+    dependencies, with the dependencies that could not be satisfied
+    ('missing', a list of (node, relation text)) and packages of the
+    closure that cannot be installed together ('conflicts', a list of
+    (node, other node, relation text)). Nodes are (repository, package,
+    version) tuples, as returned by PackageRepositorySet.grep_many.
+    """
+    def __init__(self, nodes, missing, conflicts):
+        self.nodes = nodes
+        self.missing = missing
+        self.conflicts = conflicts
+
+    def problems(self):
+        """
+        Yields ('missing' | 'conflict', description) for every problem.
+        """
+        for (r, p, v), text in self.missing:
+            yield 'missing', "{0} {1} ({2}) depends on '{3}'".format(p, v, r.name, text)
+        for (r, p, v), (other_r, other_p, other_v), text in self.conflicts:
+            yield 'conflict', "{0} {1} ({2}) conflicts with {3} {4} ({5}): '{6}'".format(
+                p, v, r.name, other_p, other_v, other_r.name, text)
+
+
+class DistroDependencyGraph():
+    """
+    Provides / depends graph of all packages of a set of repositories.
+    Relations are read once per repository, indexed by provided name per
+    packaging scheme, and every dependency is resolved at most once, so
+    closures of any number of packages share the work. Packages are
+    numbered internally, closures are walked over those numbers.
+
+    A dependency group is resolved to the highest version satisfying its
+    first satisfiable alternative, across all repositories of the same
+    scheme.
+    """
+    def __init__(self, repository_list):
+        # Node number -> node, version key, depends, conflicts
+        self.nodes = []
+        self.keys = []
+        self.depends = []
+        self.conflicts = []
+        self._numbers = {}
+        # (scheme, provided name) -> [(node number, provided version key)]
+        self.providers = {}
+        self._resolved = {}
+        self._edges = {}
+        self._closures = {}
+        for repository in repository_list:
+            scheme = repository.version_scheme
+            relations = repository.package_relations()
+            METRICS.count('packages', len(relations), scope=repository.name)
+            for package, version, key, depends, provides, conflicts in relations:
+                node = (repository, package, version)
+                if node in self._numbers:
+                    # Other builds (architectures, releases) of a version
+                    continue
+                number = self._add(node, key, depends, conflicts)
+                for name, provided_key in [(package, key)] + provides:
+                    self.providers.setdefault((scheme, name), []).append(
+                        (number, provided_key))
+
+    def _add(self, node, key=None, depends=(), conflicts=()):
+        number = len(self.nodes)
+        self._numbers[node] = number
+        self.nodes.append(node)
+        self.keys.append(key)
+        self.depends.append(depends)
+        self.conflicts.append(conflicts)
+        return number
+
+    def number(self, node):
+        """
+        Returns the number of a node; nodes unknown to the graph get one
+        too, without any dependencies.
+        """
+        if node not in self._numbers:
+            return self._add(node)
+        return self._numbers[node]
+
+    def resolve(self, scheme, group):
+        """
+        Returns the number of the node chosen to satisfy a dependency
+        group, None if no package of the repository set satisfies it.
+        """
+        if (scheme, group) not in self._resolved:
+            chosen = None
+            for name, op, key in group[1]:
+                for number, provided_key in self.providers.get((scheme, name), ()):
+                    if relation_satisfied_by(provided_key, op, key) and \
+                            (chosen is None or self.keys[number] > self.keys[chosen]):
+                        chosen = number
+                if chosen is not None:
+                    break
+            self._resolved[(scheme, group)] = chosen
+        return self._resolved[(scheme, group)]
+
+    def edges(self, number):
+        """
+        Returns ([dependency number], [unsatisfied relation text]) of a node.
+        """
+        if number not in self._edges:
+            scheme = self.nodes[number][0].version_scheme
+            dependencies = []
+            missing = []
+            for group in self.depends[number]:
+                dependency = self.resolve(scheme, group)
+                if dependency is None:
+                    missing.append(group[0])
+                elif dependency != number and dependency not in dependencies:
+                    dependencies.append(dependency)
+            self._edges[number] = (dependencies, missing)
+        return self._edges[number]
+
+    def package_closure(self, node):
+        """
+        Returns the DependencyClosure of a single package, memoized: the
+        same candidate is often matched by several requirements.
+        """
+        if node not in self._closures:
+            self._closures[node] = self.closure([node])
+        return self._closures[node]
+
+    def closure(self, roots):
+        """
+        Returns the DependencyClosure of the root nodes. Passing every
+        package of the graph ('graph.nodes') checks all repositories at
+        once.
+        """
+        numbers = [self.number(node) for node in roots]
+        seen = set(numbers)
+        visited = list(seen)
+        missing = []
+        edges = self._edges
+        # 'visited' doubles as the breadth-first queue
+        position = 0
+        while position < len(visited):
+            number = visited[position]
+            position += 1
+            dependencies, node_missing = edges.get(number) or self.edges(number)
+            if node_missing:
+                missing.extend((self.nodes[number], text) for text in node_missing)
+            for dependency in dependencies:
+                if dependency not in seen:
+                    seen.add(dependency)
+                    visited.append(dependency)
+        return DependencyClosure([self.nodes[number] for number in visited], missing,
+                                 self._conflicts(visited, seen))
+
+    def _conflicts(self, visited, members):
+        nodes = self.nodes
+        conflicts = []
+
+        # Dependents requiring different versions of the same package
+        first_versions = {}
+        for number in visited:
+            repository, package, version = nodes[number]
+            first = first_versions.setdefault((repository.version_scheme, package), number)
+            if nodes[first][2] != version:
+                conflicts.append((nodes[first], nodes[number], "only one version of {0} "
+                                                               "can be installed".format(package)))
+
+        for number in visited:
+            if not self.conflicts[number]:
+                continue
+            repository, package, version = nodes[number]
+            for text, (name, op, key) in self.conflicts[number]:
+                for other, provided_key in self.providers.get(
+                        (repository.version_scheme, name), ()):
+                    # A package may conflict with what it provides itself
+                    if other in members and nodes[other][1] != package and \
+                            relation_satisfied_by(provided_key, op, key):
+                        conflicts.append((nodes[number], nodes[other], text))
+        return conflicts
+
+
+#================================
+
+
 # Package alias classes
 #======================
 
+DEFAULT_ALIASES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'package_aliases.json')
+
+
 class PackageAlias():
     def __init__(self, name=''):
         self.name = name
 
         self.deb_package = {}
         self.rpm_package = {}
+        # Repository name -> package name, overrides deb / rpm names
+        self.repository_packages = {}
 
     def deb(self, name='', repo=''):
         self.deb_package = {
@@ -364,151 +1885,637 @@ class PackageAlias():
         }
         return self
 
+    def package_for(self, repository):
+        """
+        Returns the distribution package name in 'repository', None if the
+        alias doesn't cover it.
+        """
+        if repository.name in self.repository_packages:
+            return self.repository_packages[repository.name]
+        package = {
+            'deb': self.deb_package,
+            'rpm': self.rpm_package
+        }.get(repository.version_scheme) or {}
+        if package.get('repo') and package['repo'] != repository.name:
+            return None
+        return package.get('name') or None
+
     def __str__(self):
         return "Package '{0}' // DEB: '{1}' from '{2}' // RPM: '{3}' from '{4}'".format(
             self.name,
-            self.deb_package['name'],
-            self.deb_package['repo'],
-            self.rpm_package['name'],
-            self.rpm_package['repo']
+            self.deb_package.get('name'),
+            self.deb_package.get('repo'),
+            self.rpm_package.get('name'),
+            self.rpm_package.get('repo')
         )
 
 
 class CustomPackageSet():
+    """
+    Python package name -> distribution package name aliases, keyed by
+    PEP 503 normalized names.
+    """
     def __init__(self):
         self.items = {}
 
     def add(self, item):
-        self.items[item.name] = item
+        self.items[normalize_name(item.name)] = item
 
     def __contains__(self, item):
-        return item in self.items.keys()
+        return normalize_name(item) in self.items
+
+    def get(self, name):
+        return self.items.get(normalize_name(name))
 
     def deb_package_for(self, name):
-        item = self.items.get(name, None)
+        item = self.get(name)
         if item:
-            return item.deb_package['name']
+            return item.deb_package.get('name')
         else:
             return None
 
     def rpm_package_for(self, name):
-        item = self.items.get(name, None)
+        item = self.get(name)
         if item:
-            return item.rpm_package['name']
+            return item.rpm_package.get('name')
         else:
             return None
 
+    def aliases_for(self, names, repository):
+        """
+        Resolves the names that have an alias in 'repository' at once.
+        Returns a dict of name -> distribution package name.
+        """
+        aliases = {}
+        for name in names:
+            item = self.get(name)
+            package = item.package_for(repository) if item else None
+            if package:
+                aliases[name] = package
+        return aliases
+
+
+def load_package_aliases(path=DEFAULT_ALIASES_FILE):
+    """
+    Loads a CustomPackageSet from a JSON file of the form
+        {"<python name>": {"deb": "<name>", "rpm": "<name>",
+                           "repositories": {"<repository name>": "<name>"}}}
+    where every key of an entry is optional.
+    """
+    package_set = CustomPackageSet()
+    with open(path) as aliases_file:
+        aliases = json.load(aliases_file)
+    for name, packages in sorted(aliases.items()):
+        item = PackageAlias(name=name)
+        if packages.get('deb'):
+            item.deb(name=packages['deb'])
+        if packages.get('rpm'):
+            item.rpm(name=packages['rpm'])
+        item.repository_packages = dict(packages.get('repositories', {}))
+        package_set.add(item)
+    return package_set
 
-#======================
 
+#======================
 
-class PythonPackage():
-    def __init__(self, string, from_package=None):
-        self._raw_string = string.split('#')[0].rstrip()
-        self._from_package = from_package
-        self.name = ""
-        self.constraints = []
-        self.parents = []
 
-        if self._raw_string:
-            self.looks_good = True
+# Version comparison
+#===================
+
+DIGITS_RE = re.compile(r'(\d+)')
+RPM_SEGMENT_RE = re.compile(r'~|\d+|[a-zA-Z]+')
+PEP440_PRE_RE = re.compile(r'[.-]?(dev|a|alpha|b|beta|c|rc|pre|preview)\.?(\d*)$')
+TRAILING_ZEROS_RE = re.compile(r'(\.0+)+$')
+DEB_REPACK_RE = re.compile(r'[+~.](dfsg|ds|repack)\d*.*$')
+
+CONSTRAINT_OPERATORS = {
+    'gt': operator.gt,
+    'lt': operator.lt,
+    'ge': operator.ge,
+    'le': operator.le,
+    'eq': operator.eq,
+    'ne': operator.ne
+}
+
+
+def _dpkg_char_weight(c):
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def dpkg_string_key(string):
+    """
+    Returns a key ordering version strings the way dpkg does: alternating
+    non-digit and digit parts, '~' sorting before anything, even the end
+    of the string.
+    """
+    key = []
+    parts = DIGITS_RE.split(string)
+    for position in xrange(0, len(parts), 2):
+        key.append(tuple(_dpkg_char_weight(c) for c in parts[position]) + (0,))
+        if position + 1 < len(parts):
+            key.append(int(parts[position + 1]))
         else:
-            self.looks_good = False
-            return
-
-        match = re.search('^(.*?)([<>!=].*)$', self._raw_string)
-        if match:
-            self.name = match.group(1)
-            constraint = match.group(2).split(',')
+            key.append(0)
+    key.append((0,))
+    return tuple(key)
+
+
+def deb_version_key(version):
+    """
+    Returns a sort key for a full Debian version '[epoch:]upstream[-revision]'.
+    """
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return (int(epoch or 0), dpkg_string_key(upstream), dpkg_string_key(revision))
+
+
+def rpm_string_key(string):
+    """
+    Returns a key ordering version strings the way rpmvercmp does: numeric
+    segments are newer than alphabetic ones, '~' older than anything, and
+    a version with more segments is newer.
+    """
+    key = []
+    for segment in RPM_SEGMENT_RE.findall(string):
+        if segment == '~':
+            key.append((0,))
+        elif segment.isdigit():
+            key.append((3, int(segment)))
         else:
-            self.name = self._raw_string
-            constraint = []
-
-        for c in constraint:
-            match = re.search('^([<>!=]=?)(.*?)$', c)
-            self.constraints.append(
-                [
-                    {
-                        '>': 'gt',
-                        '<': 'lt',
-                        '>=': 'ge',
-                        '<=': 'le',
-                        '==': 'eq',
-                        '!=': 'ne'
-                    }.get(match.group(1), ''),
-                    match.group(2)
-                ]
+            key.append((2, segment))
+    key.append((1,))
+    return tuple(key)
+
+
+def rpm_version_key(epoch, version, release):
+    return (int(epoch or 0), rpm_string_key(version), rpm_string_key(release))
+
+
+def upstream_version(version, scheme='deb'):
+    """
+    Strips the distribution specific parts (epoch, Debian revision and
+    repack suffixes) from a package version, leaving the upstream version
+    that can be compared with Python requirements.
+    """
+    if scheme == 'python':
+        return python_version_to_distro(version)
+    if scheme == 'deb':
+        if ':' in version:
+            version = version.split(':', 1)[1]
+        if '-' in version:
+            version = version.rsplit('-', 1)[0]
+        version = DEB_REPACK_RE.sub('', version)
+    return version
+
+
+def python_version_to_distro(version):
+    """
+    Spells a Python version the way distributions do, so pre-releases sort
+    before the release: '1.0rc1' -> '1.0~rc1', '1.0.dev2' -> '1.0~~dev2'.
+    """
+    match = PEP440_PRE_RE.search(version)
+    if match:
+        tilde = '~~' if match.group(1) == 'dev' else '~'
+        version = "{0}{1}{2}{3}".format(
+            version[:match.start()], tilde, match.group(1), match.group(2))
+    return version
+
+
+class VersionConstraints():
+    """
+    Constraints of a Python requirement compiled once into version keys of
+    one packaging scheme ('deb', 'rpm', or 'python' for Python release
+    versions), for checking candidate versions.
+    """
+    def __init__(self, constraints, scheme='deb'):
+        self.scheme = scheme
+        self.string_key = rpm_string_key if scheme == 'rpm' else dpkg_string_key
+        self._key_cache = {}
+        self.checks = [
+            (CONSTRAINT_OPERATORS[op], self.key(python_version_to_distro(version)))
+            for op, version in constraints
+            if op in CONSTRAINT_OPERATORS
+        ]
+
+    def key(self, version):
+        # Python considers '1.0' and '1.0.0' equal, distributions don't.
+        release, tilde, pre_release = version.partition('~')
+        return self.string_key(
+            TRAILING_ZEROS_RE.sub('', release) + tilde + pre_release)
+
+    def satisfied_by(self, version):
+        """
+        Checks a repository package version against all the constraints.
+        """
+        if version not in self._key_cache:
+            key = self.key(upstream_version(version, self.scheme))
+            self._key_cache[version] = all(
+                check(key, constraint_key) for check, constraint_key in self.checks
             )
+        return self._key_cache[version]
+
+    def filter(self, versions):
+        return [v for v in versions if self.satisfied_by(v)]
+
+
+def python_version_key(version):
+    """
+    Returns a sort key for a Python release version.
+    """
+    return VersionConstraints([], scheme='python').key(
+        python_version_to_distro(version))
+
+
+#===================
+
+
+NAME_SEPARATORS_RE = re.compile(r'[-_.]+')
+REQUIREMENT_RE = re.compile(r"""
+    ^\s*(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)
+    \s*(?:\[(?P<extras>[^\]]*)\])?
+    \s*(?:@\s*(?P<url>[^\s;]+)|\(?(?P<specifier>[^;()]*?)\)?)
+    \s*(?:;\s*(?P<marker>.*?))?\s*$
+""", re.VERBOSE)
+SPECIFIER_RE = re.compile(r'^\s*(~=|===|==|!=|<=|>=|<|>)\s*([A-Za-z0-9][A-Za-z0-9.*+!_-]*)\s*$')
+SPECIFIER_OPERATORS = {
+    '>': 'gt',
+    '<': 'lt',
+    '>=': 'ge',
+    '<=': 'le',
+    '==': 'eq',
+    '===': 'eq',
+    '!=': 'ne'
+}
+
+
+def normalize_name(name):
+    """
+    Returns the PEP 503 normalized form of a Python package name.
+    """
+    return NAME_SEPARATORS_RE.sub('-', name).lower()
+
+
+def _next_release(parts):
+    """
+    Returns the release following the given release prefix, ['1', '4'] ->
+    '1.5'. None if the prefix is not numeric.
+    """
+    if not parts or not parts[-1].isdigit():
+        return None
+    return '.'.join(parts[:-1] + [str(int(parts[-1]) + 1)])
+
+
+def parse_specifier(op, version):
+    """
+    Translates one PEP 440 version clause into (op, version) constraints
+    VersionConstraints can check. '~=' and '==' prefix matches become a
+    pair of bounds; '!=' prefix matches can't be expressed and are dropped.
+    """
+    if op == '~=':
+        upper = _next_release(version.split('.')[:-1])
+        if upper:
+            return (('ge', version), ('lt', upper))
+        return (('ge', version),)
+    if version.endswith('.*'):
+        if op != '==':
+            return ()
+        release = version[:-2]
+        return (('ge', release), ('lt', _next_release(release.split('.')) or release))
+    return ((SPECIFIER_OPERATORS[op], version),)
+
+
+class PythonPackage(object):
+    """
+    One PEP 508 requirement: name, extras, version specifier, URL and
+    environment marker. Instances are immutable and hashable, equal
+    requirements compare equal.
+    """
+    __slots__ = ('_raw_string', 'name', 'extras', 'specifier', 'url', 'marker',
+                 'constraints', 'looks_good', '_compiled_constraints')
+
+    def __init__(self, string):
+        init = object.__setattr__
+        raw_string = string.split('#')[0].strip()
+        init(self, '_raw_string', raw_string)
+        init(self, '_compiled_constraints', {})
+
+        match = REQUIREMENT_RE.match(raw_string)
+        clauses = []
+        if match and match.group('specifier'):
+            clauses = [SPECIFIER_RE.match(c) for c in match.group('specifier').split(',')]
+        if not match or not all(clauses):
+            init(self, 'looks_good', False)
+            for attr in ('name', 'specifier', 'url', 'marker'):
+                init(self, attr, '')
+            init(self, 'extras', ())
+            init(self, 'constraints', ())
+            return
+
+        init(self, 'looks_good', True)
+        init(self, 'name', match.group('name'))
+        init(self, 'extras', tuple(sorted(
+            set(e.strip() for e in (match.group('extras') or '').split(',') if e.strip()))))
+        init(self, 'specifier', ','.join(c.group(1) + c.group(2) for c in clauses))
+        init(self, 'url', match.group('url') or '')
+        init(self, 'marker', match.group('marker') or '')
+        init(self, 'constraints', tuple(
+            constraint
+            for c in clauses
+            for constraint in parse_specifier(c.group(1), c.group(2))
+        ))
 
-        if self._from_package:
-            for string in self._from_package.split('->'):
-                package = PythonPackage(string)
-                if package.looks_good:
-                    self.parents.append(package)
+    def __setattr__(self, name, value):
+        raise AttributeError("PythonPackage is immutable")
+
+    def __reduce__(self):
+        return PythonPackage, (self._raw_string,)
+
+    def _identity(self):
+        return (normalize_name(self.name), self.extras, self.specifier,
+                self.url, self.marker)
+
+    def __eq__(self, other):
+        return isinstance(other, PythonPackage) and self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._identity())
 
     def __repr__(self):
-        return "(Name: '{0}', Constraints: [{1}], Parents: [{2}])".format(
+        return "(Name: '{0}', Constraints: [{1}])".format(
             self.name,
-            ' , '.join([':'.join(c) for c in self.constraints]),
-            ' -> '.join([repr(p) for p in self.parents])
+            ' , '.join([':'.join(c) for c in self.constraints])
         )
 
     def __str__(self):
-        return "{0}{1}".format(self.name, self.str_constraint())
+        if self.extras:
+            return "{0}[{1}]{2}".format(self.name, ','.join(self.extras), self.specifier)
+        return "{0}{1}".format(self.name, self.specifier)
 
     def equals(self, package, strict=False):
-        if self.name != package.name:
+        # Specifier clauses are compared rather than constraints, as
+        # '!=X.*' clauses have no constraint.
+        if normalize_name(self.name) != normalize_name(package.name):
             return False
+        return set(self.specifier.split(',')) == set(package.specifier.split(','))
 
-        if len(self.constraints) != len(package.constraints):
-            return False
+    def version_constraints(self, scheme='deb'):
+        """
+        Returns the constraints compiled for the given packaging scheme.
+        """
+        if scheme not in self._compiled_constraints:
+            self._compiled_constraints[scheme] = VersionConstraints(
+                self.constraints, scheme=scheme)
+        return self._compiled_constraints[scheme]
 
-        for c in self.constraints:
-            if not c in package.constraints:
-                return False
+    def str_constraint(self):
+        return self.specifier
 
-        return True
+    def key(self):
+        """
+        Returns the (normalized name, constraint) pair identifying the
+        requirement in a DependencyGraph.
+        """
+        return normalize_name(self.name), self.specifier
+
+
+class DependencyGraph():
+    """
+    Requirement tree of a component, stored as a DAG. There is one node per
+    (name, constraint) pair, so a requirement shared by many packages is
+    parsed and kept once, whatever number of chains lead to it. The root is
+    the component itself.
+    """
+    def __init__(self, root_name):
+        self.root = PythonPackage(root_name)
+        self._root_key = normalize_name(root_name)
+        # (name, constraint) -> PythonPackage
+        self.nodes = {}
+        # Requirement string -> PythonPackage, saves parsing repeated strings
+        self._strings = {}
+        # Edges both ways, node key -> [node key], in insertion order
+        self._requires = {self._root_key: []}
+        self._required_by = {self._root_key: []}
+        self._depth_cache = None
+
+    def _key(self, package):
+        if package is self.root:
+            return self._root_key
+        key = package.key()
+        # Chains printed by pip end with the component, maybe pinned
+        if key[0] == self._root_key:
+            return self._root_key
+        return key
+
+    def node(self, string):
+        """
+        Returns the interned node for a requirement string, None if the
+        string holds no requirement.
+        """
+        if string in self._strings:
+            return self._strings[string]
 
-    def str_constraint(self):
-        return ','.join(
-            [
-                "{0}{1}".format(
-                    {
-                        'gt': '>',
-                        'lt': '<',
-                        'ge': '>=',
-                        'le': '<=',
-                        'eq': '==',
-                        'ne': '!='
-                    }.get(c[0]), c[1]
-                )
-                for c in self.constraints
-            ]
-        )
+        package = PythonPackage(string)
+        if not package.looks_good:
+            node = None
+        else:
+            key = self._key(package)
+            if key == self._root_key:
+                node = self.root
+            else:
+                node = self.nodes.setdefault(key, package)
+                self._requires.setdefault(key, [])
+                self._required_by.setdefault(key, [])
+        self._strings[string] = node
+        return node
+
+    def add_edge(self, parent, child):
+        """
+        Records that 'parent' requires 'child'.
+        """
+        parent_key, child_key = self._key(parent), self._key(child)
+        if child_key == self._root_key:
+            return
+        if child_key not in self._requires[parent_key]:
+            self._requires[parent_key].append(child_key)
+            self._required_by[child_key].append(parent_key)
+            self._depth_cache = None
+
+    def add_chain(self, string, chain):
+        """
+        Adds a requirement together with the pip-style chain it came from,
+        'parent->grandparent->...->component'. Returns the node.
+        """
+        node = self.node(string)
+        if node is None:
+            return None
+        child = node
+        for parent_string in chain.split('->'):
+            parent = self.node(parent_string)
+            if parent is None:
+                continue
+            self.add_edge(parent, child)
+            child = parent
+        if child is not self.root:
+            self.add_edge(self.root, child)
+        return node
+
+    def _node_for_key(self, key):
+        if key == self._root_key:
+            return self.root
+        return self.nodes[key]
+
+    def requires(self, package):
+        return [self._node_for_key(k) for k in self._requires[self._key(package)]]
+
+    def required_by(self, package):
+        return [self._node_for_key(k) for k in self._required_by[self._key(package)]]
+
+    def is_direct(self, package):
+        return self._root_key in self._required_by[self._key(package)]
+
+    def dependents(self, package):
+        """
+        Returns all packages requiring 'package', directly or not.
+        """
+        result = []
+        seen = set([self._key(package)])
+        queue = deque([self._key(package)])
+        while queue:
+            for key in self._required_by[queue.popleft()]:
+                if key not in seen:
+                    seen.add(key)
+                    result.append(self._node_for_key(key))
+                    queue.append(key)
+        return result
+
+    def depth(self, package):
+        """
+        Returns the length of the shortest chain from the component to
+        'package', 0 for the component itself and None if unreachable.
+        """
+        if self._depth_cache is None:
+            depths = {self._root_key: 0}
+            queue = deque([self._root_key])
+            while queue:
+                key = queue.popleft()
+                for child_key in self._requires[key]:
+                    if child_key not in depths:
+                        depths[child_key] = depths[key] + 1
+                        queue.append(child_key)
+            self._depth_cache = depths
+        return self._depth_cache.get(self._key(package))
+
+    def path(self, package):
+        """
+        Returns the shortest chain leading to 'package' as a list of its
+        ancestors, nearest first and the component last.
+        """
+        key = self._key(package)
+        result = []
+        depth = self.depth(package)
+        while key != self._root_key and depth:
+            # Any parent one level up lies on a shortest chain
+            key = [k for k in self._required_by[key]
+                   if self._depth_cache.get(k) == depth - 1][0]
+            depth -= 1
+            result.append(self._node_for_key(key))
+        return result
+
+    def paths(self, package):
+        """
+        Yields every chain leading to 'package', in the same form as path().
+        """
+        key = self._key(package)
+        stack = [(key, [], frozenset([key]))]
+        while stack:
+            key, chain, visited = stack.pop()
+            if key == self._root_key:
+                yield chain
+                continue
+            for parent_key in self._required_by[key]:
+                # Requirements may be circular, a chain never is
+                if parent_key not in visited:
+                    stack.append((parent_key,
+                                  chain + [self._node_for_key(parent_key)],
+                                  visited | set([parent_key])))
 
 
 class GlobalRequirements():
-    def __init__(self, url):
+    def __init__(self, url, cache_root=None, timeout=30):
+        self.url = url
         self.entries = []
+        # Normalized name -> first entry with that name
+        self.index = {}
+        self.cache_threshold_sec = 60 * 60
+        self.timeout = timeout
+        # SHA1 of the snapshot content, part of cached validation keys
+        self.fingerprint = None
         print("")
         print("Loading Global Requirements ...")
-        resp = urllib2.urlopen(url)
-        for line in resp.readlines():
+
+        snapshot_path = self.update_snapshot(cache_dir_for(url, cache_root))
+        with open(snapshot_path) as snapshot:
+            content = snapshot.read()
+        self.fingerprint = hashlib.sha1(content).hexdigest()
+        for line in content.splitlines():
             req_entry = PythonPackage(line)
             if req_entry.looks_good:
                 self.entries.append(req_entry)
-        resp.close()
+                self.index.setdefault(normalize_name(req_entry.name), req_entry)
         print("Done. {0} records loaded.".format(len(self.entries)))
 
+    def update_snapshot(self, cache_dir):
+        """
+        Keeps a local copy of global-requirements.txt per URL (i.e. per
+        branch), revalidating it once it is older than cache_threshold_sec.
+        Falls back to the existing copy if the remote can't be reached.
+        """
+        snapshot_path = os.path.join(cache_dir, 'global-requirements.txt')
+
+        with cache_lock(cache_dir):
+            validators = http_validators(snapshot_path)
+            if validators:
+                file_age = time.time() - os.path.getmtime(snapshot_path + '.http')
+                if file_age <= self.cache_threshold_sec:
+                    print("Using snapshot '{0}' (validated {1} sec ago).".format(
+                        snapshot_path, int(file_age)))
+                    METRICS.count('cache_hits', scope='global-requirements')
+                    return snapshot_path
+
+            METRICS.count('cache_misses', scope='global-requirements')
+
+            try:
+                if self.download(snapshot_path, validators):
+                    print("Downloaded '{0}' --> '{1}'".format(self.url, snapshot_path))
+                else:
+                    print("Snapshot '{0}' not modified.".format(snapshot_path))
+                    mark_validated(snapshot_path)
+            except IOError as e:
+                if not os.path.exists(snapshot_path):
+                    raise
+                print("Unable to revalidate '{0}' ({1}), using snapshot '{2}'.".format(
+                    self.url, e, snapshot_path))
+
+        return snapshot_path
+
+    def download(self, path, validators=None):
+        return http_fetch(self.url, path, validators=validators,
+                          timeout=self.timeout, scope='global-requirements')
+
     def get_package(self, name):
-        for package in self.entries:
-            if package.name == name:
-                return package
+        METRICS.count('lookups', scope='global-requirements')
+        return self.index.get(normalize_name(name))
 
     def validate(self, package):
-        names = [n.name for n in self.entries]
-        if package.name in names:
-            greq_package = self.get_package(package.name)
+        greq_package = self.get_package(package.name)
+        if greq_package:
             if greq_package.equals(package):
                 return [True, greq_package]
             else:
@@ -517,24 +2524,409 @@ class GlobalRequirements():
             return [False, None]
 
 
+# Package metadata
+#=================
+
+PYPI_URL = 'https://pypi.org/pypi'
+STACKFORGE_URL = 'https://github.com/stackforge/{0}'
+PIP_DOWNLOADING_RE = re.compile(r'Downloading/unpacking (.*?) \(from (.*?)\)')
+PIP_SATISFIED_RE = re.compile(r'Requirement already satisfied.*?: (.*?) in .*?\(from (.*?)\)')
+
+
+def parse_requirement_lines(lines):
+    """
+    Returns requirement strings from requirements.txt or requires.txt
+    content, skipping comments, pip options and setuptools extras sections.
+    """
+    requirements = []
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if not line or line.startswith('-'):
+            continue
+        if line.startswith('['):
+            # requires.txt: sections for extras follow the base requirements
+            break
+        requirements.append(line)
+    return requirements
+
+
+def requires_dist_to_requirement(string):
+    """
+    Converts a 'Requires-Dist' value such as 'six (>=1.7.0)' to the
+    requirements.txt form, keeping its environment marker. Returns None
+    for requirements of extras.
+    """
+    requirement, _, marker = string.partition(';')
+    if 'extra' in marker:
+        return None
+    requirement = re.sub(r'[()\s]', '', requirement)
+    if marker.strip():
+        return "{0}; {1}".format(requirement, marker.strip())
+    return requirement
+
+
+def read_distribution_requires(path):
+    """
+    Reads the requirements of a wheel from its METADATA, or those of a
+    source distribution from its egg-info requires.txt (or pbr's
+    requirements.txt), without unpacking the archive.
+    """
+    if path.endswith('.whl'):
+        archive = zipfile.ZipFile(path)
+        try:
+            for name in archive.namelist():
+                if name.endswith('.dist-info/METADATA'):
+                    return [
+                        r for r in (
+                            requires_dist_to_requirement(line.split(':', 1)[1])
+                            for line in archive.read(name).splitlines()
+                            if line.startswith('Requires-Dist:')
+                        ) if r
+                    ]
+            return []
+        finally:
+            archive.close()
+
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        names = archive.namelist()
+        read = archive.read
+    else:
+        archive = tarfile.open(path)
+        names = archive.getnames()
+        read = lambda name: archive.extractfile(name).read()
+
+    try:
+        for suffix in ('.egg-info/requires.txt', '/requirements.txt'):
+            found = sorted(
+                [n for n in names if n.endswith(suffix)],
+                key=lambda n: n.count('/')
+            )
+            if found:
+                return parse_requirement_lines(read(found[0]).splitlines())
+        return []
+    finally:
+        archive.close()
+
+
+PYTHON_SPECIFIER_RE = re.compile(r'^\s*(~=|===|==|!=|<=|>=|<|>)\s*(\S+)\s*$')
+PYTHON_TAGS = set([
+    'py{0}'.format(sys.version_info[0]),
+    'py{0}{1}'.format(*sys.version_info[:2]),
+    'cp{0}{1}'.format(*sys.version_info[:2]),
+])
+
+
+def marker_applies(marker):
+    """
+    Tells whether an environment marker holds for the running interpreter.
+    Markers that can't be evaluated are taken as true.
+    """
+    if not marker:
+        return True
+    try:
+        return pkg_resources.evaluate_marker(marker)
+    except (SyntaxError, ValueError):
+        return True
+
+
+def python_requirement_applies(requires_python):
+    """
+    Tells whether a 'Requires-Python' value such as '>=2.7,!=3.0.*' allows
+    the running interpreter.
+    """
+    clauses = [PYTHON_SPECIFIER_RE.match(c) for c in (requires_python or '').split(',')
+               if c.strip()]
+    if not clauses or not all(clauses):
+        return True
+    return marker_applies(' and '.join(
+        'python_full_version {0} "{1}"'.format(*m.groups()) for m in clauses))
+
+
+def release_file_usable(url_info):
+    """
+    Tells whether pip running this interpreter could install a release
+    file: its Requires-Python must allow the interpreter and a wheel must
+    be built for its Python version.
+    """
+    if not python_requirement_applies(url_info.get('requires_python')):
+        return False
+    filename = url_info.get('filename', '')
+    if filename.endswith('.whl'):
+        parts = filename[:-4].split('-')
+        return len(parts) >= 5 and bool(PYTHON_TAGS & set(parts[-3].split('.')))
+    return True
+
+
+class PackageMetadataCache():
+    """
+    Looks up requirements of Python packages without installing them.
+
+    An installed distribution is used if it satisfies the requirement, as
+    pip does. Otherwise the best matching release is looked up on the
+    package index. Project data is revalidated like repository indexes, and
+    requirements of every release are cached for good, as releases never
+    change.
+    """
+    def __init__(self, cache_root=None, index_url=PYPI_URL, timeout=30):
+        self.cache_dir = os.path.abspath(
+            os.path.join(cache_root or DEFAULT_CACHE_ROOT, 'pypi'))
+        self.index_url = index_url.rstrip('/')
+        self.timeout = timeout
+        self.cache_threshold_sec = 60 * 60
+        # Number of lookups that failed, as opposed to finding nothing
+        self.failures = 0
+        ensure_dir(self.cache_dir)
+
+    def requires(self, package):
+        """
+        Returns (version, [requirement strings]) of the release chosen for
+        the requirement 'package', or (None, []) if nothing matches.
+        """
+        installed = self.installed_requires(package)
+        if installed:
+            METRICS.count('installed_hits', scope='package-index')
+            return installed
+
+        version = self.best_release(package)
+        if version is None:
+            return None, []
+        try:
+            return version, self.release_requires(package.name, version)
+        except (IOError, OSError, KeyError, tarfile.TarError, zipfile.BadZipfile) as e:
+            print("Unable to read requirements of '{0}=={1}': {2}".format(
+                package.name, version, e))
+            self.failures += 1
+            return version, []
+
+    def installed_requires(self, package):
+        try:
+            distribution = pkg_resources.get_distribution(package.name)
+        except (pkg_resources.ResolutionError, ValueError):
+            return None
+        if not package.version_constraints('python').satisfied_by(distribution.version):
+            return None
+        return distribution.version, [str(r) for r in distribution.requires()]
+
+    def project(self, name):
+        """
+        Returns the package index data of a project, or None if it is
+        unknown or can't be fetched.
+        """
+        path = os.path.join(self.cache_dir, normalize_name(name) + '.json')
+        url = "{0}/{1}/json".format(self.index_url, name)
+
+        # Projects are locked one by one, so that concurrent runs only
+        # wait for each other when they need the same project.
+        with cache_lock(self.cache_dir, os.path.basename(path) + '.lock'):
+            validators = http_validators(path)
+            file_age = None
+            if validators:
+                file_age = time.time() - os.path.getmtime(path + '.http')
+            if file_age is None or file_age > self.cache_threshold_sec:
+                METRICS.count('cache_misses', scope='package-index')
+                try:
+                    if not http_fetch(url, path, validators=validators,
+                                      timeout=self.timeout, scope='package-index'):
+                        mark_validated(path)
+                except IOError as e:
+                    if not os.path.exists(path):
+                        print("Unable to get data for '{0}': {1}".format(name, e))
+                        # An unknown project is an answer, not a failure
+                        if not (isinstance(e, urllib2.HTTPError) and e.code == 404):
+                            self.failures += 1
+                        return None
+            else:
+                METRICS.count('cache_hits', scope='package-index')
+
+        with open(path) as project_file:
+            return json.load(project_file)
+
+    def best_release(self, package):
+        project = self.project(package.name)
+        if not project:
+            return None
+
+        constraints = package.version_constraints('python')
+        candidates = [
+            version for version, files in project.get('releases', {}).items()
+            if not PEP440_PRE_RE.search(version) and constraints.satisfied_by(version)
+            and any(release_file_usable(f) for f in files)
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=python_version_key)
+
+    def release_requires(self, name, version):
+        path = os.path.join(
+            self.cache_dir, "{0}-{1}.requires.json".format(normalize_name(name), version))
+        if os.path.exists(path):
+            METRICS.count('cache_hits', scope='package-index')
+            with open(path) as requires_file:
+                return json.load(requires_file)
+
+        with cache_lock(self.cache_dir, os.path.basename(path) + '.lock'):
+            # Another run may have read the release meanwhile
+            if os.path.exists(path):
+                METRICS.count('cache_hits', scope='package-index')
+                with open(path) as requires_file:
+                    return json.load(requires_file)
+
+            METRICS.count('cache_misses', scope='package-index')
+            requires = self.fetch_release_requires(name, version)
+            with open(path + '.part', 'w') as requires_file:
+                json.dump(requires, requires_file)
+            os.rename(path + '.part', path)
+        return requires
+
+    def fetch_release_requires(self, name, version):
+        url = "{0}/{1}/{2}/json".format(self.index_url, name, version)
+        METRICS.count('http_requests', scope='package-index')
+        try:
+            response = urllib2.urlopen(url, timeout=self.timeout)
+            try:
+                release = json.load(response)
+            finally:
+                response.close()
+        except urllib2.HTTPError as e:
+            if e.code != 404:
+                raise
+            # Index without per-release data, use the project file list.
+            url = "{0}/{1}/json".format(self.index_url, name)
+            release = {
+                'info': {},
+                'urls': (self.project(name) or {}).get('releases', {}).get(version, [])
+            }
+
+        requires_dist = release['info'].get('requires_dist')
+        if requires_dist is not None:
+            return [
+                r for r in (requires_dist_to_requirement(s) for s in requires_dist) if r
+            ]
+
+        # Older releases have no metadata on the index, read it from the
+        # distribution itself, preferring wheels over source archives.
+        files = sorted(
+            release.get('urls', []),
+            key=lambda f: 0 if f.get('packagetype') == 'bdist_wheel' else 1
+        )
+        for url_info in files:
+            if url_info.get('packagetype') not in ('bdist_wheel', 'sdist') \
+                    or not release_file_usable(url_info):
+                continue
+            file_url = urlparse.urljoin(url, url_info['url'])
+            # Each call downloads into a directory of its own, concurrent
+            # runs may be reading the same file.
+            download_dir = mkdtemp(prefix='murano-scripts-')
+            try:
+                file_path = os.path.join(download_dir, os.path.basename(url_info['filename']))
+                print("Reading requirements from '{0}' ...".format(file_url))
+                http_fetch(file_url, file_path, timeout=self.timeout, scope='package-index')
+                return read_distribution_requires(file_path)
+            finally:
+                shutil.rmtree(download_dir, True)
+        return []
+
+
+#=================
+
+
+# Result cache
+#=============
+
+# Bumped whenever the cached structures change
+RESULT_CACHE_FORMAT = 3
+COMPONENT_INPUT_FILES = ('requirements.txt', 'test-requirements.txt', 'setup.cfg')
+GIT_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+class ResultCache():
+    """
+    Resolved requirements and validation results of earlier runs, stored
+    under a hash of everything they were computed from. A changed input
+    gives a new key, so entries are never updated in place.
+    """
+    def __init__(self, cache_root=None):
+        self.cache_dir = os.path.abspath(
+            os.path.join(cache_root or DEFAULT_CACHE_ROOT, 'results'))
+        ensure_dir(self.cache_dir)
+
+    def key(self, *parts):
+        return hashlib.sha1('\0'.join([str(RESULT_CACHE_FORMAT)] + list(parts))).hexdigest()
+
+    def load(self, key):
+        """
+        Returns the data stored under 'key', None if there is none.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, key), 'rb') as result_file:
+                data = pickle.load(result_file)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            data = None
+        METRICS.count('cache_hits' if data is not None else 'cache_misses',
+                      scope='results')
+        return data
+
+    def save(self, key, data):
+        path = os.path.join(self.cache_dir, key)
+        with cache_lock(self.cache_dir):
+            with open(path + '.part', 'wb') as result_file:
+                pickle.dump(data, result_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.part', path)
+
+
+#=============
+
+
 class RequirementsResolver():
-    def __init__(self):
-        self._pip_install_opts = ['--no-install', '--verbose']
+    def __init__(self, method='metadata', metadata_cache=None, cache_root=None,
+                 result_cache=None):
+        self._pip_install_opts = ['--no-install', '--verbose', '-e']
+        self.method = method
+        self.cache_root = cache_root
+        self.metadata_cache = metadata_cache
         self.package_name = ""
         self.entries = []
-        pass
+        self._entry_set = set()
+        self.graph = None
+        self.listeners = []
+        # Results of unchanged components are taken from the result cache.
+        # 'fingerprint' is the cache key of the resolved inputs.
+        self.result_cache = result_cache
+        self.fingerprint = None
+        self.component_id = None
+        # Requirement key -> (version, requires) found by the metadata
+        # resolver. Those of the previous run of the component are reused,
+        # so only new or changed requirements are looked up again.
+        self.expansions = {}
+        self._previous_expansions = {}
+        # Packages whose requirements could not be looked up. A tree with
+        # such gaps is incomplete and is never cached.
+        self.lookup_failures = []
+
+    def add_listener(self, callback):
+        """
+        Registers a callable invoked with every PythonPackage as soon as it
+        is discovered, while the rest of the tree is still being resolved.
+        """
+        self.listeners.append(callback)
+
+    def _add_package(self, package):
+        self.entries.append(package)
+        self._entry_set.add(package)
+        print("  [{0}] {1}".format(len(self.entries), package))
+        for callback in self.listeners:
+            callback(package)
 
-    def _add_pip_package(self, string, from_package=None):
-        package = PythonPackage(string, from_package=from_package)
-        if package.looks_good:
-            self.entries.append(package)
+    def _add_pip_package(self, string, from_package):
+        package = self.graph.add_chain(string, from_package)
+        if package is not None and package not in self._entry_set:
+            self._add_package(package)
 
     def resolve_from_dir(self, path):
-        self._pip_install_opts.append('-e')
         if not os.path.exists(path):
             raise Exception("Path not found '{0}'".format(path))
-
-        rm('-r', '-f', "/tmp/pip_build_{0}".format(getuser()))
+        self.component_id = self.component_id or os.path.abspath(path)
 
         with pushd(path):
             print("")
@@ -543,34 +2935,236 @@ class RequirementsResolver():
             print(git('status'))
             print("------------")
 
-            self.package_name = tail(python("setup.py", "--name"), "-1").rstrip()
+            if self.result_cache:
+                self.fingerprint = self._fingerprint(self._head_commit(), '.')
+                if self._use_result(self.result_cache.load(self.fingerprint)):
+                    return
+                previous = self.result_cache.load(
+                    self.result_cache.key('latest', self.component_id))
+                if previous:
+                    self._previous_expansions = previous['expansions']
+
+            self.package_name = self._read_package_name()
+            self.graph = DependencyGraph(self.package_name)
 
             print("")
             print("Gathering package requirements ...")
-            for line in pip('install', self._pip_install_opts, '.'):
-                string = line.rstrip()
-                match = re.search(
-                    'Downloading/unpacking (.*?) \(from (.*?)\)',
-                    string
-                )
-                if match:
-                    self._add_pip_package(match.group(1), from_package=match.group(2))
-                    continue
-
-                match = re.search(
-                    'Requirement already satisfied.*?: (.*?) in .*?\(from (.*?)\)',
-                    string
-                )
-                if match:
-                    self._add_pip_package(match.group(1), from_package=match.group(2))
-                    continue
+            with METRICS.stage('resolve', scope=self.package_name):
+                if self.method == 'pip':
+                    self._resolve_with_pip()
+                else:
+                    self._resolve_with_metadata()
             print("Done. {0} records found.".format(len(self.entries)))
 
-    def resolve_from_stackforge(self, url):
-        pass
+        self._previous_expansions = {}
+        if self.lookup_failures:
+            print("Requirements of {0} packages could not be looked up, "
+                  "the result is not cached.".format(len(self.lookup_failures)))
+            self.fingerprint = None
+        elif self.result_cache:
+            self._save_result(self.fingerprint)
+            self._save_result(self.result_cache.key('latest', self.component_id))
 
-    def resolve_from_git(self, url):
-        pass
+    def _fingerprint(self, commit, path=None):
+        """
+        Returns the result cache key of the component at 'commit', taking
+        the requirement files in 'path' into account, as they may differ
+        from the committed ones.
+        """
+        index_url = self.metadata_cache.index_url if self.metadata_cache else PYPI_URL
+        parts = [self.method, index_url, commit]
+        if path is not None:
+            for name in COMPONENT_INPUT_FILES:
+                file_path = os.path.join(path, name)
+                if os.path.exists(file_path):
+                    with open(file_path, 'rb') as input_file:
+                        parts.append(name + ':' + hashlib.sha1(input_file.read()).hexdigest())
+        return self.result_cache.key(*parts)
+
+    def _head_commit(self):
+        try:
+            return str(git('rev-parse', 'HEAD')).strip()
+        except ErrorReturnCode:
+            return ''
+
+    def _remote_commit(self, url, ref):
+        """
+        Returns the commit 'ref' points to in the remote repository without
+        fetching it, None if it can't be determined.
+        """
+        if GIT_SHA_RE.match(ref):
+            return ref
+        try:
+            output = str(git('ls-remote', url, ref))
+        except ErrorReturnCode:
+            return None
+        for line in output.splitlines():
+            commit, _, name = line.partition('\t')
+            if name in (ref, 'refs/heads/' + ref, 'refs/tags/' + ref):
+                return commit
+        return None
+
+    def _use_result(self, data):
+        """
+        Takes the resolved requirements from result cache data. Listeners
+        are notified of every package, as for a fresh resolution.
+        """
+        if not data:
+            return False
+        self.package_name = data['package_name']
+        self.graph = data['graph']
+        self.expansions = data['expansions']
+        print("")
+        print("Requirements are unchanged, using the previous result ...")
+        for package in data['entries']:
+            self._add_package(package)
+        print("Done. {0} records found.".format(len(self.entries)))
+        return True
+
+    def _save_result(self, key):
+        self.result_cache.save(key, {
+            'package_name': self.package_name,
+            'entries': self.entries,
+            'graph': self.graph,
+            'expansions': self.expansions
+        })
+
+    def _read_package_name(self):
+        config = ConfigParser.RawConfigParser()
+        config.read('setup.cfg')
+        if config.has_option('metadata', 'name'):
+            return config.get('metadata', 'name').strip()
+        return tail(python("setup.py", "--name"), "-1").rstrip()
+
+    def _read_requirements(self):
+        if os.path.exists('requirements.txt'):
+            with open('requirements.txt') as requirements_file:
+                return parse_requirement_lines(requirements_file)
+
+        config = ConfigParser.RawConfigParser()
+        config.read('setup.cfg')
+        if config.has_option('options', 'install_requires'):
+            return parse_requirement_lines(
+                config.get('options', 'install_requires').splitlines())
+
+        for name in sorted(os.listdir('.')):
+            requires_path = os.path.join(name, 'requires.txt')
+            if name.endswith('.egg-info') and os.path.exists(requires_path):
+                with open(requires_path) as requires_file:
+                    return parse_requirement_lines(requires_file)
+        return []
+
+    def _resolve_with_metadata(self):
+        """
+        Walks the dependency tree breadth-first, the way pip does: the first
+        requirement seen for a package wins and only that one is expanded.
+        Every requirement is still recorded as an edge of the graph.
+        """
+        if not self.metadata_cache:
+            self.metadata_cache = PackageMetadataCache()
+
+        seen = set([normalize_name(self.package_name)])
+        queue = deque(
+            (string, self.graph.root) for string in self._read_requirements()
+        )
+        applies = {}
+        while queue:
+            string, parent = queue.popleft()
+            # Requirements gated by environment markers pip would skip on
+            # this interpreter are not part of the tree.
+            if string not in applies:
+                applies[string] = marker_applies(PythonPackage(string).marker)
+            if not applies[string]:
+                continue
+            package = self.graph.node(string)
+            if package is None:
+                continue
+            self.graph.add_edge(parent, package)
+            key = normalize_name(package.name)
+            if key in seen:
+                continue
+            seen.add(key)
+            self._add_package(package)
+
+            version, requires = self._expand(package)
+            for requirement in requires:
+                queue.append((requirement, package))
+
+    def _expand(self, package):
+        key = package.key()
+        if key not in self.expansions:
+            if key in self._previous_expansions:
+                METRICS.count('reused_expansions', scope=self.package_name)
+                self.expansions[key] = self._previous_expansions[key]
+            else:
+                failures = self.metadata_cache.failures
+                expansion = self.metadata_cache.requires(package)
+                if self.metadata_cache.failures > failures:
+                    self.lookup_failures.append(package)
+                    return expansion
+                self.expansions[key] = expansion
+        return self.expansions[key]
+
+    def _resolve_with_pip(self):
+        rm('-r', '-f', "/tmp/pip_build_{0}".format(getuser()))
+
+        # Lines are parsed as pip prints them, not after it exits.
+        self.parse_pip_output(pip('install', self._pip_install_opts, '.', _iter=True))
+
+    def parse_pip_output(self, lines):
+        """
+        Collects requirements from 'pip install --verbose' output lines.
+        """
+        if self.graph is None:
+            self.graph = DependencyGraph(self.package_name)
+        for line in lines:
+            match = PIP_DOWNLOADING_RE.search(line) or PIP_SATISFIED_RE.search(line)
+            if match:
+                self._add_pip_package(match.group(1), from_package=match.group(2))
+
+    def resolve_from_stackforge(self, name, ref='master'):
+        self.resolve_from_git(STACKFORGE_URL.format(name), ref=ref)
+
+    def resolve_from_git(self, url, ref='master'):
+        """
+        Resolves a component straight from its git repository. The
+        repository is kept as a bare mirror in the cache directory and only
+        fetched incrementally; 'ref' is checked out into a temporary
+        worktree sharing the mirror's objects.
+        """
+        # The committed tree is all the input there is, so a known commit
+        # needs neither a fetch nor a worktree.
+        self.component_id = url
+        commit = self._remote_commit(url, ref) if self.result_cache else None
+        if commit and self._use_result(self.result_cache.load(self._fingerprint(commit))):
+            self.fingerprint = self._fingerprint(commit)
+            return
+
+        cache_dir = cache_dir_for(url, self.cache_root)
+        mirror_path = os.path.join(cache_dir, 'mirror.git')
+
+        with cache_lock(cache_dir), METRICS.stage('git', scope=url):
+            if os.path.exists(mirror_path):
+                print("Fetching '{0}' into '{1}' ...".format(url, mirror_path))
+                git('--git-dir', mirror_path, 'fetch', '--prune', 'origin')
+            else:
+                print("Mirroring '{0}' into '{1}' ...".format(url, mirror_path))
+                git('clone', '--mirror', url, mirror_path)
+
+            worktree_path = mkdtemp(prefix='worktree-', dir=cache_dir)
+            git('--git-dir', mirror_path, 'worktree', 'add', '--detach',
+                worktree_path, ref)
+
+        try:
+            self.resolve_from_dir(worktree_path)
+        finally:
+            with cache_lock(cache_dir):
+                rm('-rf', worktree_path)
+                git('--git-dir', mirror_path, 'worktree', 'prune')
+
+        if commit and not self.lookup_failures:
+            self.fingerprint = self._fingerprint(commit)
+            self._save_result(self.fingerprint)
 
     def validate(self, global_requirements):
         """
@@ -579,9 +3173,20 @@ class RequirementsResolver():
                 'orig_package': <package found in component's requirements>,
                 'greq_package': <package found in global requirements>,
                 'status': <if package complies with global requirements>,
-                'is_direct_dependency': <if package is a direct dependency for the component>
+                'is_direct_dependency': <if package is a direct dependency for the component>,
+                'parents': <shortest requirement chain, nearest parent first>
             }
+        Results for unchanged requirements and global requirements are
+        taken from the result cache.
         """
+        key = None
+        if self.result_cache and self.fingerprint and global_requirements.fingerprint:
+            key = self.result_cache.key(
+                'validation', self.fingerprint, global_requirements.fingerprint)
+            result = self.result_cache.load(key)
+            if result is not None:
+                return result
+
         result = {}
         for package in self.entries:
             status, greq_package = global_requirements.validate(package)
@@ -589,109 +3194,108 @@ class RequirementsResolver():
                 'orig_package': package,
                 'greq_package': greq_package,
                 'status': status,
-                'is_direct_dependency': self.package_name == package.parents[0].name
+                'is_direct_dependency': self.graph.is_direct(package),
+                'parents': self.graph.path(package)
             }
+        if key:
+            self.result_cache.save(key, result)
         return result
 
 
-class ReportGenerator():
-    def __init__(self, package_name):
-        self.package_name = package_name
-        self.header = ''
+def group_validation_result(validation_result):
+    """
+    Splits a validation result into report blocks in one pass. Returns an
+    OrderedDict of (compatible, direct) -> sorted keys, in report order.
+    """
+    groups = OrderedDict(
+        ((compatible, direct), [])
+        for direct in (True, False) for compatible in (True, False)
+    )
+    for key in sorted(validation_result.keys()):
+        item = validation_result[key]
+        groups[(item['status'], item['is_direct_dependency'])].append(key)
+    return groups
+
+
+def _required_by(item):
+    required_by = " -> ".join([str(p) for p in item['parents']])
+    # Items of merged reports also name every component requiring them
+    if item.get('components'):
+        required_by += " [components: {0}]".format(', '.join(item['components']))
+    return required_by
+
+
+class ReportWriter():
+    """
+    Receives report records as they are produced and writes them to a
+    stream. A writer may get several reports (one per component and the
+    merged one); close() is called once at the end.
+    """
+    # Whether the output is meant for programs, which progress messages
+    # on the same stream would break
+    structured = False
+    # Whether close() closes the stream, set for files opened for the writer
+    owns_stream = False
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream else sys.stdout
+
+    def write(self, line=""):
+        self.stream.write(line + "\n")
+
+    def start_validation(self, package_name):
+        pass
 
-    def _top_block_delimiter(self, header):
-        self.header = header
-        print("")
-        print(self.header)
-        print("=" * len(self.header))
+    def start_block(self, compatible, direct, count):
+        pass
 
-    def _bottom_block_delimiter(self):
-        print("=" * len(self.header))
+    def validation_item(self, item, compatible, direct):
+        pass
 
-    def print_report_block(self, validation_result, compatible=False, direct=False):
-        str_direct = 'direct' if direct else 'indirect'
-        str_compatible = 'compatible' if compatible else 'incompatible'
+    def end_block(self, compatible, direct, count):
+        pass
 
-        self._top_block_delimiter("{0} dependencies {1} with global requirements:".format(
-            str_direct.capitalize(), str_compatible
-        ))
-        count = 0
-        for key in sorted(validation_result.keys()):
-            item = validation_result[key]
-            if item['status'] == compatible and item['is_direct_dependency'] == direct:
-                count += 1
-                if item['greq_package']:
-                    greq_status = "Global Requirements: {0}".format(item['greq_package'])
-                else:
-                    greq_status = "Not found in Global Requirements"
+    def end_validation(self):
+        pass
 
-                if direct:
-                    str_parents = "  "
-                else:
-                    str_parents = "(From: {0})".format(
-                        " -> ".join([str(p) for p in item['orig_package'].parents])
-                    )
-
-                print("{0} {1} # {2}".format(item['orig_package'], str_parents, greq_status))
-        self._bottom_block_delimiter()
-
-        print("Total: {0}".format(count))
-
-    def print_machine_friendly_report_block(self, validation_result, compatible=False, direct=False):
-        str_direct = 'direct' if direct else 'indirect'
-        str_compatible = 'compatible' if compatible else 'incompatible'
-        delimiter = ";"
-
-        print("#")
-        for key in sorted(validation_result.keys()):
-            item = validation_result[key]
-            if item['status'] == compatible and item['is_direct_dependency'] == direct:
-                str_parents = " -> ".join([str(p) for p in item['orig_package'].parents])
-
-                print("{1:35}{0}{2:15}{0}{3:10}{0}{4:35}{0}{5}".format(
-                    delimiter,
-                    item['greq_package'],
-                    str_compatible,
-                    str_direct,
-                    item['orig_package'],
-                    str_parents
-                ))
+    def start_matching(self, package_name):
+        pass
 
-    def package_matching_report_block(self, validation_result=None, repository_set=None, direct=True):
-        str_direct = 'direct' if direct else 'indirect'
-
-        for key in sorted(validation_result.keys()):
-            item = validation_result[key]
-            if item['is_direct_dependency'] == direct:
-                str_orig_package = str(item['orig_package'].name)
-                str_greq_package = str(item['greq_package'])
-                print("# {0}".format(item['orig_package']))
-                for r, p, v in repository_set.grep_package(item['orig_package'].name):
-                    print("{1:25}{0}{2:10}{0}{3:35}{0}{4:40}{0}{5}".format(
-                        ';',
-                        str_orig_package,
-                        str_direct,
-                        str_greq_package,
-                        ' '.join([p, v]),
-                        r.name
-                    ))
+    def matching_item(self, item, direct, matches):
+        """
+        'matches' is a list of (repository, package, version, satisfies).
+        """
+        pass
 
-    def global_requirements_validation(self, validation_result):
-        print("")
-        print("Report for package '{0}':".format(self.package_name))
+    def end_matching(self):
+        pass
 
-        self.print_report_block(validation_result=validation_result,
-                                compatible=True, direct=True)
-        self.print_report_block(validation_result=validation_result,
-                                compatible=False, direct=True)
-        self.print_report_block(validation_result=validation_result,
-                                compatible=True, direct=False)
-        self.print_report_block(validation_result=validation_result,
-                                compatible=False, direct=False)
+    def start_closure(self, package_name):
+        pass
 
-    def machine_friendly_report(self, validation_result):
-        print("")
-        print("#{1:35}{0}{2:15}{0}{3:10}{0}{4:35}{0}{5}".format(
+    def closure_item(self, item, direct, candidate, closure):
+        """
+        'candidate' is a satisfying (repository, package, version) match of
+        the requirement, 'closure' its DependencyClosure.
+        """
+        pass
+
+    def end_closure(self):
+        pass
+
+    def close(self):
+        self.stream.flush()
+        if self.owns_stream:
+            self.stream.close()
+
+
+class MachineFriendlyReportWriter(ReportWriter):
+    """
+    ';' delimited fixed-width columns, one line per requirement.
+    """
+    def start_validation(self, package_name):
+        self.write("")
+        self.write("#{1:35}{0}{2:15}{0}{3:10}{0}{4:35}{0}{5}".format(
             ';',
             'Global Requirements',
             'Is Compatible',
@@ -699,143 +3303,745 @@ class ReportGenerator():
             'Component Requirements',
             'Required By'
         ))
-        self.print_machine_friendly_report_block(validation_result=validation_result,
-                                                 compatible=True, direct=True)
-        self.print_machine_friendly_report_block(validation_result=validation_result,
-                                                 compatible=False, direct=True)
-        self.print_machine_friendly_report_block(validation_result=validation_result,
-                                                 compatible=True, direct=False)
-        self.print_machine_friendly_report_block(validation_result=validation_result,
-                                                 compatible=False, direct=False)
-        print("")
 
-    def package_matching(self, validation_result=None, repository_set=None):
-        print("")
-        print("Looking for packages matching:")
-        self.package_matching_report_block(validation_result=validation_result,
-                                             repository_set=repository_set, direct=True)
-        self.package_matching_report_block(validation_result=validation_result,
-                                             repository_set=repository_set, direct=False)
-        print("")
+    def start_block(self, compatible, direct, count):
+        self.write("#")
 
-#===============================================================================
+    def validation_item(self, item, compatible, direct):
+        self.write("{1:35}{0}{2:15}{0}{3:10}{0}{4:35}{0}{5}".format(
+            ';',
+            item['greq_package'],
+            'compatible' if compatible else 'incompatible',
+            'direct' if direct else 'indirect',
+            item['orig_package'],
+            _required_by(item)
+        ))
 
-custom_python_packages = CustomPackageSet()
-
-custom_python_packages.add(PackageAlias(name='SQLAlchemy').deb(name='python-sqlalchemy'))
-custom_python_packages.add(PackageAlias(name='PasteDeploy').deb(name='python-pastedeploy'))
-custom_python_packages.add(PackageAlias(name='Routes').deb(name='python-routes'))
-custom_python_packages.add(PackageAlias(name='sqlalchemy-migrate').deb(name='python-migrate'))
-custom_python_packages.add(PackageAlias(name='pycrypto').deb(name='python-crypto'))
-custom_python_packages.add(PackageAlias(name='Paste').deb(name='python-paste'))
-custom_python_packages.add(PackageAlias(name='pyOpenSSL').deb(name='python-openssl'))
-custom_python_packages.add(PackageAlias(name='repoze.lru').deb(name='repoze'))
-custom_python_packages.add(PackageAlias(name='Tempita').deb(name='python-tempita'))
-custom_python_packages.add(PackageAlias(name='Babel').deb(name='python-babel'))
-custom_python_packages.add(PackageAlias(name='PyYAML').deb(name='python-yaml'))
-custom_python_packages.add(PackageAlias(name='PrettyTable').deb(name='python-prettytable'))
-custom_python_packages.add(PackageAlias(name='pytz').deb(name='python-tz'))
-custom_python_packages.add(PackageAlias(name='WebOb').deb(name='python-webob'))
+    def end_validation(self):
+        self.write("")
+
+    def start_matching(self, package_name):
+        self.write("")
+        self.write("Looking for packages matching:")
+
+    def matching_item(self, item, direct, matches):
+        self.write("# {0}".format(item['orig_package']))
+        for r, p, v, satisfies in matches:
+            self.write("{1:25}{0}{2:10}{0}{3:35}{0}{4:40}{0}{5}{0}{6}".format(
+                ';',
+                str(item['orig_package'].name),
+                'direct' if direct else 'indirect',
+                str(item['greq_package']),
+                ' '.join([p, v]),
+                r.name,
+                'satisfies' if satisfies else 'unsatisfied'
+            ))
+
+    def end_matching(self):
+        self.write("")
+
+    def start_closure(self, package_name):
+        self.write("")
+        self.write("Distribution dependency closure of satisfying packages:")
+
+    def closure_item(self, item, direct, candidate, closure):
+        r, p, v = candidate
+        problems = list(closure.problems())
+        self.write("# {0}: {1} {2} ({3}), {4} packages, {5}".format(
+            item['orig_package'], p, v, r.name, len(closure.nodes),
+            "{0} problems".format(len(problems)) if problems else 'complete'))
+        for problem, description in problems:
+            self.write("{1:10}{0}{2}".format(';', problem, description))
+
+    def end_closure(self):
+        self.write("")
+
+
+class TextReportWriter(MachineFriendlyReportWriter):
+    """
+    Human readable blocks per compatible / direct combination with totals.
+    """
+    def start_validation(self, package_name):
+        self.write("")
+        self.write("Report for package '{0}':".format(package_name))
+
+    def start_block(self, compatible, direct, count):
+        self.header = "{0} dependencies {1} with global requirements:".format(
+            'Direct' if direct else 'Indirect',
+            'compatible' if compatible else 'incompatible')
+        self.write("")
+        self.write(self.header)
+        self.write("=" * len(self.header))
+
+    def validation_item(self, item, compatible, direct):
+        if item['greq_package']:
+            greq_status = "Global Requirements: {0}".format(item['greq_package'])
+        else:
+            greq_status = "Not found in Global Requirements"
 
-#===============================================================================
+        if direct:
+            str_parents = "  "
+        else:
+            str_parents = "(From: {0})".format(_required_by(item))
 
-parser = argparse.ArgumentParser(description="Resolve package dependencies")
+        self.write("{0} {1} # {2}".format(item['orig_package'], str_parents, greq_status))
 
-parser.add_argument('--git-dir', dest='git_dir', default='/home/dim/Temp/glance',
-                    help='Local GIT repository path.')
+    def end_block(self, compatible, direct, count):
+        self.write("=" * len(self.header))
+        self.write("Total: {0}".format(count))
 
-parser.add_argument('--greq-branch', dest='greq_branch', default='master',
-                    help='Global Requirements branch.')
+    def end_validation(self):
+        pass
 
-parser.add_argument('--fuel-release', dest='fuel_release', default='5.0.1',
-                    help='Current FUEL release.')
 
-parser.add_argument('--rpm', dest='check_rpm_packages', action='store_true',
-                    help='Search for RPM packages matching the requirements.')
-parser.add_argument('--rpm-os-version', dest='rpm_os_version', default='centos',
-                    help='Specify OS name for RPM package repository.')
-parser.add_argument('--rpm-os-release', dest='rpm_os_release', default='6.5',
-                    help='Specify OS release name for RPM package repository.')
+REPORT_FIELDS = ['report', 'component', 'package', 'global_requirement', 'compatible',
+                 'direct', 'required_by', 'repository', 'repository_package',
+                 'version', 'satisfies', 'source', 'depends', 'provides', 'filename',
+                 'closure_size', 'problem', 'description']
 
-parser.add_argument('--deb', dest='check_deb_packages', action='store_true',
-                    help='Search for DEB packages matching the requirements.')
-parser.add_argument('--deb-os-version', dest='deb_os_version', default='ubuntu',
-                    help='Specify OS name for DEB package repository.')
-parser.add_argument('--deb-os-release', dest='deb_os_release', default='precise',
-                    help='Specify OS release name for DEB package repository.')
+# Report field -> repository index field of a matched package
+PACKAGE_REPORT_FIELDS = [
+    ('source', 'Source'),
+    ('depends', 'Depends'),
+    ('provides', 'Provides'),
+    ('filename', 'Filename')
+]
 
-parser.add_argument('--repo-type', dest='mirantis_repo_type', default='product',
-                    help='Mirantis repository for package search.')
 
-parser.add_argument('--internal', dest='use_internal_mirantis_repo', action='store_true',
-                    help='Use internal Mirantis repository for package search.')
-parser.add_argument('--public', dest='use_public_mirantis_repo', action='store_true',
-                    help='Use public Mirantis repository for package search.')
-parser.add_argument('--upstream', dest='use_upstream_public_repo', action='store_true',
-                    help='Use upstream (DEB or RPM) repository for package search.')
+class CsvReportWriter(ReportWriter):
+    """
+    CSV with a header line, one row per requirement and per repository
+    match. Columns not relevant to a row are left empty.
+    """
+    structured = True
 
-args = parser.parse_args()
+    def __init__(self, stream=None):
+        ReportWriter.__init__(self, stream)
+        self.writer = csv.DictWriter(self.stream, REPORT_FIELDS)
+        self.writer.writerow(dict(zip(REPORT_FIELDS, REPORT_FIELDS)))
 
-#===============================================================================
+    def start_validation(self, package_name):
+        self.package_name = package_name
+
+    def validation_item(self, item, compatible, direct):
+        self.writer.writerow({
+            'report': 'validation',
+            'component': self.package_name,
+            'package': item['orig_package'],
+            'global_requirement': item['greq_package'] or '',
+            'compatible': compatible,
+            'direct': direct,
+            'required_by': _required_by(item)
+        })
+
+    def start_matching(self, package_name):
+        self.package_name = package_name
+
+    def matching_item(self, item, direct, matches):
+        for r, p, v, satisfies in matches:
+            row = {
+                'report': 'matching',
+                'component': self.package_name,
+                'package': item['orig_package'],
+                'global_requirement': item['greq_package'] or '',
+                'direct': direct,
+                'repository': r.name,
+                'repository_package': p,
+                'version': v,
+                'satisfies': satisfies
+            }
+            package_fields = r.package_fields(p, v)
+            for field, index_field in PACKAGE_REPORT_FIELDS:
+                if index_field in package_fields:
+                    row[field] = package_fields[index_field]
+            self.writer.writerow(row)
+
+    def start_closure(self, package_name):
+        self.package_name = package_name
+
+    def closure_item(self, item, direct, candidate, closure):
+        # One row per problem, a single row without one for a complete closure
+        r, p, v = candidate
+        for problem, description in list(closure.problems()) or [('', '')]:
+            self.writer.writerow({
+                'report': 'closure',
+                'component': self.package_name,
+                'package': item['orig_package'],
+                'global_requirement': item['greq_package'] or '',
+                'direct': direct,
+                'repository': r.name,
+                'repository_package': p,
+                'version': v,
+                'closure_size': len(closure.nodes),
+                'problem': problem,
+                'description': description
+            })
+
+
+class JsonLinesReportWriter(CsvReportWriter):
+    """
+    One JSON object per line, with the same fields as the CSV rows.
+    """
+    def __init__(self, stream=None):
+        ReportWriter.__init__(self, stream)
+        self.writer = self
+
+    def writerow(self, row):
+        record = dict((field, None) for field in REPORT_FIELDS)
+        record.update(row)
+        for field in ('package', 'global_requirement'):
+            record[field] = str(record[field]) if record[field] else None
+        self.write(json.dumps(record, sort_keys=True))
+
+
+class JUnitReportWriter(ReportWriter):
+    """
+    JUnit XML for CI: a test suite per report and a test case per
+    requirement, failing for requirements incompatible with global
+    requirements and for packages without a satisfying repository match.
+    """
+    structured = True
+
+    def __init__(self, stream=None):
+        ReportWriter.__init__(self, stream)
+        self.write('<?xml version="1.0" encoding="UTF-8"?>')
+        self.write('<testsuites>')
+
+    def _testcase(self, classname, name, failure=None, output=None):
+        self.write('  <testcase classname={0} name={1}>'.format(
+            quoteattr(classname), quoteattr(name)))
+        if failure:
+            self.write('    <failure message={0}/>'.format(quoteattr(failure)))
+        if output:
+            self.write('    <system-out>{0}</system-out>'.format(xml_escape(output)))
+        self.write('  </testcase>')
+
+    def start_validation(self, package_name):
+        self.package_name = package_name
+        self.suite = 'global-requirements.' + package_name
+        self.write('<testsuite name={0}>'.format(quoteattr(self.suite)))
+
+    def validation_item(self, item, compatible, direct):
+        failure = None
+        if not compatible:
+            if item['greq_package']:
+                failure = "Global Requirements: {0}".format(item['greq_package'])
+            else:
+                failure = "Not found in Global Requirements"
+        self._testcase(self.suite, str(item['orig_package']), failure,
+                       "Required by: {0}".format(_required_by(item)))
+
+    def end_validation(self):
+        self.write('</testsuite>')
+
+    def start_matching(self, package_name):
+        self.suite = 'package-matching.' + package_name
+        self.write('<testsuite name={0}>'.format(quoteattr(self.suite)))
+
+    def matching_item(self, item, direct, matches):
+        failure = None
+        if not any(satisfies for r, p, v, satisfies in matches):
+            failure = "No repository package satisfies the requirement"
+        self._testcase(self.suite, str(item['orig_package']), failure, "\n".join(
+            "{0} {1} ({2}): {3}".format(
+                p, v, r.name, 'satisfies' if satisfies else 'unsatisfied')
+            for r, p, v, satisfies in matches))
+
+    def end_matching(self):
+        self.write('</testsuite>')
+
+    def start_closure(self, package_name):
+        self.suite = 'dependency-closure.' + package_name
+        self.write('<testsuite name={0}>'.format(quoteattr(self.suite)))
+
+    def closure_item(self, item, direct, candidate, closure):
+        r, p, v = candidate
+        problems = list(closure.problems())
+        failure = None
+        if problems:
+            failure = "{0} missing and {1} conflicting dependencies".format(
+                len(closure.missing), len(closure.conflicts))
+        self._testcase(self.suite, "{0} {1} {2} ({3})".format(
+            item['orig_package'], p, v, r.name), failure,
+            "\n".join("{0}: {1}".format(problem, description)
+                      for problem, description in problems))
+
+    def end_closure(self):
+        self.write('</testsuite>')
+
+    def close(self):
+        self.write('</testsuites>')
+        ReportWriter.close(self)
+
+
+REPORT_WRITERS = OrderedDict([
+    ('machine', MachineFriendlyReportWriter),
+    ('text', TextReportWriter),
+    ('csv', CsvReportWriter),
+    ('jsonl', JsonLinesReportWriter),
+    ('junit', JUnitReportWriter)
+])
 
-greq_branch = {
-    'icehouse': 'stable/icehouse'
-}.get(args.greq_branch, args.greq_branch)
 
-greq_url = "https://raw.githubusercontent.com/openstack/requirements/{0}/global-requirements.txt".format(greq_branch)
+class ReportGenerator():
+    """
+    Builds reports from a validation result in a single grouping pass and
+    streams the records to the writers. Without writers, each report goes
+    to stdout in its traditional format.
+    """
+    def __init__(self, package_name, writers=None):
+        self.package_name = package_name
+        self.writers = writers
+
+    def _writers(self, default_writer):
+        if self.writers is not None:
+            return self.writers
+        return [default_writer()]
+
+    def validation_report(self, validation_result, writers=None):
+        if writers is None:
+            writers = self._writers(MachineFriendlyReportWriter)
+        for writer in writers:
+            writer.start_validation(self.package_name)
+        for (compatible, direct), keys in group_validation_result(validation_result).items():
+            for writer in writers:
+                writer.start_block(compatible, direct, len(keys))
+            for key in keys:
+                for writer in writers:
+                    writer.validation_item(validation_result[key], compatible, direct)
+            for writer in writers:
+                writer.end_block(compatible, direct, len(keys))
+        for writer in writers:
+            writer.end_validation()
 
-print("""
+    def global_requirements_validation(self, validation_result):
+        self.validation_report(validation_result, self._writers(TextReportWriter))
+
+    def machine_friendly_report(self, validation_result):
+        self.validation_report(validation_result,
+                               self._writers(MachineFriendlyReportWriter))
+
+    def _matches(self, validation_result, repository_set):
+        """
+        Yields (item, direct, [(repository, package, version, satisfies)])
+        for every requirement, direct ones first, each sorted by key.
+        """
+        groups = group_validation_result(validation_result)
+        for direct in (True, False):
+            keys = list(heapq.merge(groups[(True, direct)], groups[(False, direct)]))
+            matches = repository_set.grep_many(
+                [validation_result[key]['orig_package'].name for key in keys])
+            for key in keys:
+                item = validation_result[key]
+                yield item, direct, [
+                    (r, p, v, item['orig_package'].version_constraints(
+                        r.version_scheme).satisfied_by(v))
+                    for r, p, v in matches[item['orig_package'].name]
+                ]
+
+    def package_matching(self, validation_result=None, repository_set=None):
+        writers = self._writers(MachineFriendlyReportWriter)
+        for writer in writers:
+            writer.start_matching(self.package_name)
+        for item, direct, item_matches in self._matches(validation_result, repository_set):
+            for writer in writers:
+                writer.matching_item(item, direct, item_matches)
+        for writer in writers:
+            writer.end_matching()
+
+    def dependency_closure(self, validation_result=None, repository_set=None):
+        """
+        Reports, for every repository package satisfying a requirement,
+        whether its own dependencies can be installed from the repository
+        set.
+        """
+        writers = self._writers(MachineFriendlyReportWriter)
+        graph = repository_set.dependency_graph()
+        for writer in writers:
+            writer.start_closure(self.package_name)
+        for item, direct, item_matches in self._matches(validation_result, repository_set):
+            for r, p, v, satisfies in item_matches:
+                if not satisfies:
+                    continue
+                closure = graph.package_closure((r, p, v))
+                for writer in writers:
+                    writer.closure_item(item, direct, (r, p, v), closure)
+        for writer in writers:
+            writer.end_closure()
+
+#===============================================================================
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description="Resolve package dependencies")
+
+    parser.add_argument('--git-dir', dest='git_dir', default='/home/dim/Temp/glance',
+                        help='Local GIT repository path.')
+    parser.add_argument('--git-url', dest='git_url', default=None,
+                        help='Remote GIT repository URL, used instead of --git-dir.')
+    parser.add_argument('--stackforge', dest='stackforge', default=None,
+                        help='Stackforge project name, used instead of --git-dir.')
+    parser.add_argument('--git-ref', dest='git_ref', default='master',
+                        help='Branch, tag or commit to check out with --git-url or --stackforge.')
+    parser.add_argument('--component', dest='components', action='append', default=[],
+                        help="Batch mode: component to check, a local path or a GIT URL "
+                             "with an optional '#<ref>' suffix. May be repeated; "
+                             "resolved in parallel and followed by a merged report.")
+
+    parser.add_argument('--resolver', dest='resolver', default='metadata',
+                        choices=['metadata', 'pip'],
+                        help="How to resolve requirements: read package metadata "
+                             "directly, or scrape a 'pip install --no-install' run.")
+    parser.add_argument('--index-url', dest='index_url', default=PYPI_URL,
+                        help='Package index used by the metadata resolver.')
+
+    parser.add_argument('--greq-branch', dest='greq_branch', default='master',
+                        help='Global Requirements branch.')
+
+    parser.add_argument('--fuel-release', dest='fuel_release', default='5.0.1',
+                        help='Current FUEL release.')
+
+    parser.add_argument('--rpm', dest='check_rpm_packages', action='store_true',
+                        help='Search for RPM packages matching the requirements.')
+    parser.add_argument('--rpm-os-version', dest='rpm_os_version', default='centos',
+                        help='Specify OS name for RPM package repository.')
+    parser.add_argument('--rpm-os-release', dest='rpm_os_release', default='6.5',
+                        help='Specify OS release name for RPM package repository.')
+
+    parser.add_argument('--deb', dest='check_deb_packages', action='store_true',
+                        help='Search for DEB packages matching the requirements.')
+    parser.add_argument('--deb-os-version', dest='deb_os_version', default='ubuntu',
+                        help='Specify OS name for DEB package repository.')
+    parser.add_argument('--deb-os-release', dest='deb_os_release', default='precise',
+                        help='Specify OS release name for DEB package repository.')
+
+    parser.add_argument('--cache-dir', dest='cache_dir', default=DEFAULT_CACHE_ROOT,
+                        type=os.path.abspath,
+                        help='Directory for repository caches shared between runs.')
+    parser.add_argument('--no-result-cache', dest='use_result_cache', action='store_false',
+                        help='Resolve and validate requirements again even if the '
+                             'component and global requirements are unchanged.')
+
+    parser.add_argument('--jobs', dest='jobs', type=int, default=4,
+                        help='Number of repositories refreshed (and components '
+                             'resolved) in parallel.')
+    parser.add_argument('--report', dest='reports', action='append', default=[],
+                        metavar='FORMAT[:PATH]',
+                        help='Report format, one of: {0}. Written to PATH if given, '
+                             'to stdout otherwise. Can be repeated to produce several '
+                             'reports in one run (default: machine).'.format(
+                                 ', '.join(REPORT_WRITERS.keys())))
+    parser.add_argument('--aliases', dest='aliases_file', default=DEFAULT_ALIASES_FILE,
+                        help='JSON file mapping Python package names to DEB and RPM '
+                             'package names.')
+    parser.add_argument('--module-map', dest='module_map', action='store_true',
+                        help='Map Python packages to the DEB / RPM packages shipping '
+                             'them, using the Contents-amd64.gz or filelists index '
+                             'of each repository. Aliases take precedence.')
+    parser.add_argument('--closure', dest='closure', action='store_true',
+                        help='Check that the distribution dependencies of every '
+                             'satisfying package can be installed from the same '
+                             'repositories; report missing and conflicting ones.')
+    parser.add_argument('--metrics', dest='metrics_file', default=None,
+                        help='Write timings, downloads, subprocess launches, cache '
+                             'hits and lookup counts per stage and per repository '
+                             'to this file as JSON.')
+    parser.add_argument('--profile', dest='profile_file', default=None,
+                        help='Write cProfile statistics of the main thread to '
+                             'this file.')
+
+    parser.add_argument('--repo-type', dest='mirantis_repo_type', default='product',
+                        help='Mirantis repository for package search.')
+
+    parser.add_argument('--internal', dest='use_internal_mirantis_repo', action='store_true',
+                        help='Use internal Mirantis repository for package search.')
+    parser.add_argument('--public', dest='use_public_mirantis_repo', action='store_true',
+                        help='Use public Mirantis repository for package search.')
+    parser.add_argument('--upstream', dest='use_upstream_public_repo', action='store_true',
+                        help='Use upstream (DEB or RPM) repository for package search.')
+    return parser
+
+
+def build_repository_set(args):
+    """
+    Queues the repositories selected on the command line. They are not
+    refreshed yet, call refresh() on the returned set.
+    Returns None if no package search was requested.
+    """
+    if not (args.check_rpm_packages or args.check_deb_packages):
+        return None
+
+    repo_set = PackageRepositorySet(cache_root=args.cache_dir,
+                                    module_maps=args.module_map)
+    repo_set.add_custom_packages(
+        custom_package_set=load_package_aliases(args.aliases_file))
+
+    if args.check_rpm_packages:
+        if args.use_internal_mirantis_repo:
+            repo_set.add(MirantisInternalRepositoryRpm(
+                repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release),
+                refresh=False)
+        if args.use_public_mirantis_repo:
+            repo_set.add(MirantisPublicRepositoryRpm(
+                repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release),
+                refresh=False)
+        if args.use_upstream_public_repo:
+            repo_set.add(UpstreamPublicRepositoryRpm(fuel_release=args.fuel_release),
+                         refresh=False)
+
+    if args.check_deb_packages:
+        if args.use_internal_mirantis_repo:
+            repo_set.add(MirantisInternalRepositoryDeb(
+                repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release),
+                refresh=False)
+        if args.use_public_mirantis_repo:
+            repo_set.add(MirantisPublicRepositoryDeb(
+                repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release),
+                refresh=False)
+        if args.use_upstream_public_repo:
+            repo_set.add(UpstreamPublicRepositoryDeb(fuel_release=args.fuel_release),
+                         refresh=False)
+
+    return repo_set
+
+
+def parse_component(component, default_ref='master'):
+    """
+    Splits a --component value into (git_url, ref, git_dir); exactly one
+    of git_url and git_dir is set.
+    """
+    if '://' in component or component.startswith('git@'):
+        url, _, ref = component.partition('#')
+        return url, ref or default_ref, None
+    return None, None, component
+
+
+def build_report_writers(reports):
+    """
+    Returns report writers for the --report values, None for the default
+    stdout report.
+    """
+    if not reports:
+        return None
+    writers = []
+    for report in reports:
+        report_format, _, path = report.partition(':')
+        if report_format not in REPORT_WRITERS:
+            raise Exception("Unknown report format '{0}'".format(report_format))
+        writer = REPORT_WRITERS[report_format](open(path, 'w') if path else None)
+        writer.owns_stream = bool(path)
+        writers.append(writer)
+    return writers
+
+
+def resolve_component(options, listener=None):
+    """
+    Resolves requirements of one component. Runs in a worker process in
+    batch mode, so it takes and returns only picklable values.
+    'listener' is called with every package as soon as it is found.
+    """
+    git_url, git_ref, git_dir, method, cache_root, index_url, use_result_cache = options
+    reqs = RequirementsResolver(
+        method=method,
+        metadata_cache=PackageMetadataCache(cache_root=cache_root,
+                                            index_url=index_url),
+        cache_root=cache_root,
+        result_cache=ResultCache(cache_root) if use_result_cache else None)
+    if listener:
+        reqs.add_listener(listener)
+    if git_url:
+        reqs.resolve_from_git(git_url, ref=git_ref)
+    else:
+        reqs.resolve_from_dir(git_dir)
+    return reqs
+
+
+def resolve_component_worker(options):
+    """
+    Batch mode worker: resolves a component and returns the resolver
+    together with the metrics collected in this process.
+    """
+    METRICS.reset()
+    reqs = resolve_component(options)
+    return reqs, METRICS.as_dict()
+
+
+def merge_validation_results(results):
+    """
+    Merges validation results of several components into one union result.
+    A package is reported as direct if any component requires it directly
+    and as compatible only if it is compatible everywhere. The requirement
+    shown is an incompatible one if there is any, preferring direct ones.
+    Each item also lists the components requiring it under 'components'.
+    Packages are merged by normalized name, so 'SQLAlchemy' and
+    'sqlalchemy' are one item.
+    """
+    def rank(item):
+        return (not item['status'], item['is_direct_dependency'])
+
+    merged = {}
+    shown_rank = {}
+    for package_name, validation_result in results:
+        for name, item in validation_result.items():
+            key = normalize_name(name)
+            if key not in merged:
+                merged[key] = dict(item, components=[])
+                shown_rank[key] = rank(item)
+            merged_item = merged[key]
+            if rank(item) > shown_rank[key]:
+                shown_rank[key] = rank(item)
+                merged_item['orig_package'] = item['orig_package']
+                merged_item['parents'] = item['parents']
+            merged_item['status'] = merged_item['status'] and item['status']
+            merged_item['is_direct_dependency'] = \
+                merged_item['is_direct_dependency'] or item['is_direct_dependency']
+            merged_item['components'].append(package_name)
+    return merged
+
+
+def main():
+    args = build_argument_parser().parse_args()
+
+    profile = None
+    if args.profile_file:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run(args)
+    finally:
+        sys.stdout = sys.__stdout__
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile_file)
+        if args.metrics_file:
+            METRICS.save(args.metrics_file)
+
+
+def run(args):
+    greq_branch = {
+        'icehouse': 'stable/icehouse'
+    }.get(args.greq_branch, args.greq_branch)
+
+    greq_url = "https://raw.githubusercontent.com/openstack/requirements/{0}/global-requirements.txt".format(greq_branch)
+
+    if args.stackforge:
+        args.git_url = STACKFORGE_URL.format(args.stackforge)
+
+    if args.components:
+        components = [parse_component(c, args.git_ref) for c in args.components]
+        component_source = "{0} components: {1}".format(
+            len(components), ', '.join(args.components))
+    elif args.git_url:
+        components = [(args.git_url, args.git_ref, None)]
+        component_source = "GIT repository '{0}' ({1})".format(args.git_url, args.git_ref)
+    else:
+        components = [(None, None, args.git_dir)]
+        component_source = "local GIT repository '{0}'".format(args.git_dir)
+
+    writers = build_report_writers(args.reports)
+    if any(w.structured and w.stream is sys.stdout for w in writers or []):
+        # Progress messages go to stderr, stdout carries the report
+        sys.stdout = sys.stderr
+
+    print("""
 SUMMARY:
 --------
-Resolving dependencies for python component located in local GIT repository '{0}'
+Resolving dependencies for python component located in {0}
 Global Requirements are from '{1}' branch, fetched from URL '{2}'
 Target FUEL release: {3}
 --------""".format(
-    args.git_dir,
-    args.greq_branch,
-    greq_url,
-    args.fuel_release
-))
+        component_source,
+        args.greq_branch,
+        greq_url,
+        args.fuel_release
+    ))
+
+    with METRICS.stage('global_requirements'):
+        greq = GlobalRequirements(greq_url, cache_root=args.cache_dir)
+
+    options = [
+        (git_url, git_ref, git_dir, args.resolver, args.cache_dir, args.index_url,
+         args.use_result_cache)
+        for git_url, git_ref, git_dir in components
+    ]
+    # Worker processes are forked before any thread is started.
+    pool = None
+    if len(options) > 1:
+        pool = multiprocessing.Pool(max(1, min(args.jobs, len(options))))
+
+    # Repositories are refreshed in the background while requirements are
+    # resolved. Every package found is looked up right away, so most of the
+    # matching is done by the time the reports are printed.
+    repo_set = build_repository_set(args)
+    if repo_set:
+        def refresh():
+            with METRICS.stage('refresh'):
+                repo_set.refresh(jobs=args.jobs)
+        refresher = threading.Thread(target=refresh)
+        refresher.start()
+        prefetch = lambda package: repo_set.prefetch(package.name)
+    else:
+        prefetch = None
+
+    if pool is None:
+        resolvers = [resolve_component(options[0], listener=prefetch)]
+    else:
+        # Components are resolved in worker processes and each one is
+        # looked up as soon as its worker is done.
+        resolvers = []
+        try:
+            for reqs, metrics in pool.imap(resolve_component_worker, options):
+                METRICS.merge(metrics)
+                resolvers.append(reqs)
+                if prefetch:
+                    for package in reqs.entries:
+                        prefetch(package)
+        finally:
+            pool.close()
+            pool.join()
+
+    if repo_set:
+        refresher.join()
+
+    results = []
+    for reqs in resolvers:
+        with METRICS.stage('validate'):
+            validation_result = reqs.validate(greq)
+        results.append((reqs.package_name, validation_result))
+
+        with METRICS.stage('report'):
+            report = ReportGenerator(package_name=reqs.package_name, writers=writers)
+            report.validation_report(validation_result=validation_result)
+            if repo_set:
+                report.package_matching(validation_result=validation_result,
+                                        repository_set=repo_set)
+            if repo_set and args.closure:
+                report.dependency_closure(validation_result=validation_result,
+                                          repository_set=repo_set)
+
+    if len(results) > 1:
+        with METRICS.stage('report'):
+            merged_result = merge_validation_results(results)
+            report = ReportGenerator(package_name=', '.join(name for name, _ in results),
+                                     writers=writers)
+            print("")
+            print("Merged report for components: {0}".format(report.package_name))
+            report.validation_report(validation_result=merged_result)
+            if repo_set:
+                report.package_matching(validation_result=merged_result,
+                                        repository_set=repo_set)
+            if repo_set and args.closure:
+                report.dependency_closure(validation_result=merged_result,
+                                          repository_set=repo_set)
+
+    if repo_set:
+        repo_set.close()
+
+    for writer in writers or []:
+        writer.close()
+
 
-greq = GlobalRequirements(greq_url)
-
-reqs = RequirementsResolver()
-reqs.resolve_from_dir(args.git_dir)
-
-validation_result = reqs.validate(greq)
-
-report = ReportGenerator(package_name=reqs.package_name)
-report.machine_friendly_report(validation_result=validation_result)
-
-repo_set = PackageRepositorySet()
-repo_set.add_custom_packages(custom_package_set=custom_python_packages)
-
-validate_packages = False
-if args.check_rpm_packages:
-    validate_packages = True
-    if args.use_internal_mirantis_repo:
-        repo_set.add(MirantisInternalRepositoryRpm(
-            repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release))
-    if args.use_public_mirantis_repo:
-        repo_set.add(MirantisPublicRepositoryRpm(
-            repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release))
-    if args.use_upstream_public_repo:
-        repo_set.add(UpstreamPublicRepositoryRpm(fuel_release=args.fuel_release))
-
-if args.check_deb_packages:
-    validate_packages = True
-    if args.use_internal_mirantis_repo:
-        repo_set.add(MirantisInternalRepositoryDeb(
-            repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release))
-    if args.use_public_mirantis_repo:
-        repo_set.add(MirantisPublicRepositoryDeb(
-            repo_type=args.mirantis_repo_type, fuel_release=args.fuel_release))
-    if args.use_upstream_public_repo:
-        repo_set.add(UpstreamPublicRepositoryDeb(fuel_release=args.fuel_release))
-
-if validate_packages:
-    report.package_matching(validation_result=validation_result,
-                            repository_set=repo_set)
+if __name__ == '__main__':
+    main()
 
 
 # Example of produced output:
@@ -1,11 +1,48 @@
 __author__ = 'dim'
 
 from tempfile import mkdtemp
-from sh import grep_dctrl
 from sh import wget
-from sh import awk
-from sh import zcat
 import os.path, time
+import re
+import io
+import gzip
+import zlib
+
+
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+
+def read_packages_gz(path):
+    """
+    Yields (package, version) pairs for every stanza of a gzipped
+    Debian 'Packages' index.
+    """
+    package = version = None
+    with io.BufferedReader(gzip.open(path)) as index_file:
+        for line in index_file:
+            if not line.strip():
+                if package and version:
+                    yield package, version
+                package = version = None
+                continue
+            if line.startswith('Package:'):
+                package = line[8:].strip()
+            elif line.startswith('Version:'):
+                version = line[8:].strip()
+    if package and version:
+        yield package, version
+
+
+def dash_suffixes(name):
+    """
+    Yields 'name' and every part of it that follows a dash, i.e. all the
+    strings that '(^|-)<suffix>$' would match in it.
+    """
+    yield name
+    position = name.find('-')
+    while position != -1:
+        yield name[position + 1:]
+        position = name.find('-', position + 1)
 
 
 class PackageRepository():
@@ -16,25 +53,50 @@ class PackageRepository():
         self.local_packages_gz = ''
         self.cache_threshold_sec = 60 * 60
         self.broken = False
+        self.package_names = []
+        self.package_index = {}
+        # Dash-delimited suffix -> package names, in index order. Answers
+        # the default '(^|-)name$' match with a single probe.
+        self.suffix_index = {}
+        self._match_cache = {}
         print("")
         print("New repository '{0}'".format(name))
 
-    def grep_package(self, name, pattern="(^|-){0}$"):
-        try:
+    def grep_package(self, name, pattern=None):
+        if not pattern and not REGEX_METACHARACTERS.intersection(name):
             return [
-                line.rstrip().split(' ', 1)
-                for line in awk(
-                    grep_dctrl(
-                        zcat(self.local_packages_gz),
-                            '-F', 'Package',
-                            '-e', pattern.format(name),
-                            '-s', 'Package,Version'
-                        ),
-                    '/Package/{p=$2;next} /Version/{print p " " $2}'
-                )
+                [p, v]
+                for p in self.suffix_index.get(name, [])
+                for v in self.package_index[p]
+            ]
+
+        expression = (pattern or "(^|-){0}$").format(name)
+        if expression not in self._match_cache:
+            try:
+                regex = re.compile(expression)
+            except re.error:
+                return []
+            self._match_cache[expression] = [
+                p for p in self.package_names if regex.search(p)
             ]
-        except:
-            return []
+        return [
+            [p, v]
+            for p in self._match_cache[expression]
+            for v in self.package_index[p]
+        ]
+
+    def load_index(self):
+        self.package_names = []
+        self.package_index = {}
+        self.suffix_index = {}
+        self._match_cache = {}
+        for package, version in read_packages_gz(self.local_packages_gz):
+            if package not in self.package_index:
+                self.package_names.append(package)
+                self.package_index[package] = []
+                for suffix in dash_suffixes(package):
+                    self.suffix_index.setdefault(suffix, []).append(package)
+            self.package_index[package].append(version)
 
     def test_cache(self):
         if self.local_packages_gz:
@@ -60,6 +122,12 @@ class PackageRepository():
                 wget(self.packages_gz_url, '-O', self.local_packages_gz)
             except:
                 self.broken = True
+                return
+
+        try:
+            self.load_index()
+        except (IOError, EOFError, zlib.error):
+            self.broken = True
 
     def __str__(self):
         return "Remote URL: {0}, Cached file: {1}".format(
@@ -126,9 +194,10 @@ class PackageRepositorySet():
         self.custom_package_set = custom_package_set
 
     def grep_package(self, name):
+        package = name
+        if self.custom_package_set and name in self.custom_package_set:
+            package = self.custom_package_set.deb_package_for(name) or name
         for repository in self.repository_list:
-            if name in self.custom_package_set:
-                name = self.custom_package_set.deb_package_for(name)
-            for p, v in repository.grep_package(name=name):
+            for p, v in repository.grep_package(name=package):
                 yield repository, p, v
 